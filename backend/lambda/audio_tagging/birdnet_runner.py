@@ -0,0 +1,443 @@
+"""
+In-process BirdNET inference.
+
+Loads the BirdNET TFLite model and label list from an extracted
+BirdNET-Analyzer directory once per container and classifies audio directly,
+returning detections in memory instead of spawning `birdnet_analyzer.analyze`
+and parsing its selection tables back.
+
+The same module is shipped in the audio_tagging and query4_latest images.
+"""
+import io
+import os
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+from collections import Counter
+from multiprocessing.connection import wait
+
+import numpy as np
+
+# BirdNET V2.4 input: 3 s mono windows at 48 kHz
+SAMPLE_RATE = 48000
+WINDOW_SECONDS = 3.0
+MIN_WINDOW_SECONDS = 1.0
+BATCH_SIZE = 16
+SIGMOID_SENSITIVITY = 1.0
+# Overlap between consecutive windows when streaming; 0 matches the analyzer default
+OVERLAP_SECONDS = float(os.environ.get("BIRDNET_OVERLAP", "0.0"))
+FFMPEG = os.environ.get("FFMPEG_PATH", "ffmpeg")
+
+MODEL_FILENAME = os.environ.get("BIRDNET_MODEL_FILE", "BirdNET_GLOBAL_6K_V2.4_Model_FP32.tflite")
+LABELS_FILENAME = os.environ.get("BIRDNET_LABELS_FILE", "BirdNET_GLOBAL_6K_V2.4_Labels.txt")
+# Same default as the analyzer CLI's --min_conf
+MIN_CONFIDENCE = float(os.environ.get("BIRDNET_MIN_CONFIDENCE", "0.1"))
+
+# Parallelism: BIRDNET_WORKERS > 1 shards batches across that many processes (one
+# interpreter thread each); otherwise one interpreter uses BIRDNET_THREADS intra-op threads.
+# Both default to the container's vCPU count.
+CPU_COUNT = os.cpu_count() or 1
+WORKERS = int(os.environ.get("BIRDNET_WORKERS", "0"))
+THREADS = int(os.environ.get("BIRDNET_THREADS", str(CPU_COUNT)))
+
+# Activity gate: a window is only classified if some 40 ms frame is louder than
+# ACTIVITY_MIN_RMS_DB (dBFS) and some frame has a tonal sub-band. Tonality is the
+# ratio of arithmetic to geometric mean power within one of ACTIVITY_BANDS_HZ, in dB
+# (spectral flatness inverted): about 2.5 dB for noise, higher when a narrow-band
+# call concentrates energy in a few bins. Measured per 1 kHz band, a faint call only
+# has to stand out from the noise in its own band, not across the whole spectrum.
+# With the 5 dB default a steady 4 kHz tone at amplitude 0.02 in sigma 0.05 white
+# noise always passes, brief sweeps pass from about amplitude 0.03, and about 80%
+# of noise-only windows are skipped, as is silence.
+ACTIVITY_GATE = os.environ.get("BIRDNET_ACTIVITY_GATE", "1") == "1"
+ACTIVITY_MIN_RMS_DB = float(os.environ.get("BIRDNET_ACTIVITY_MIN_RMS_DB", "-60"))
+ACTIVITY_MIN_TONALITY_DB = float(os.environ.get("BIRDNET_ACTIVITY_MIN_TONALITY_DB", "5.0"))
+ACTIVITY_FRAME_SECONDS = 0.04
+# Low calls (owls) share one band below 1 kHz, then 1 kHz bands up to 10 kHz
+ACTIVITY_BANDS_HZ = [250.0] + [1000.0 * k for k in range(1, 11)]
+
+_runners = {}
+
+
+def find_file(root, filename):
+    """Locate a file anywhere under the extracted BirdNET-Analyzer directory."""
+    for dirpath, _, filenames in os.walk(root):
+        if filename in filenames:
+            return os.path.join(dirpath, filename)
+    raise FileNotFoundError(f"{filename} not found under {root}")
+
+
+def load_audio(path, sample_rate=SAMPLE_RATE):
+    """Decode an audio file to mono float32 at the model's sample rate."""
+    import librosa
+    signal, _ = librosa.load(path, sr=sample_rate, mono=True, res_type="kaiser_fast")
+    return signal.astype(np.float32, copy=False)
+
+
+def stream_windows(source, batch_size=BATCH_SIZE, overlap=OVERLAP_SECONDS, sample_rate=SAMPLE_RATE):
+    """
+    Decode `source` (local path or http(s) URL) with ffmpeg to mono float32 PCM and
+    yield (windows, starts) batches of WINDOW_SECONDS windows as the audio arrives.
+
+    Memory is constant: samples are read straight into one reusable window buffer
+    and copied into one reusable batch array, so `windows` is only valid until the
+    next batch is requested. Window handling of the tail matches split_windows.
+    """
+    window = int(WINDOW_SECONDS * sample_rate)
+    hop = window - int(overlap * sample_rate)
+    if hop <= 0:
+        raise ValueError("overlap must be shorter than the window")
+    min_tail = int(MIN_WINDOW_SECONDS * sample_rate)
+
+    cmd = [FFMPEG, "-nostdin", "-hide_banner", "-loglevel", "error", "-i", source,
+           "-f", "f32le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+    # stderr goes to a file: a pipe that is only read after stdout is exhausted lets ffmpeg
+    # block on a full stderr pipe (lots of warnings from a corrupt input) and never finish
+    errors = tempfile.TemporaryFile()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)
+
+    buffer = np.zeros(window, dtype=np.float32)
+    buffer_bytes = memoryview(buffer).cast("B")
+    batch = np.zeros((batch_size, window), dtype=np.float32)
+    starts = []
+    filled = 0      # bytes of buffer holding samples
+    carried = 0     # bytes carried over from the previous window (the overlap)
+    position = 0    # start of the current window, in samples
+    try:
+        while True:
+            read = proc.stdout.readinto(buffer_bytes[filled:])
+            if not read:
+                break
+            filled += read
+            if filled < len(buffer_bytes):
+                continue
+
+            batch[len(starts)] = buffer
+            starts.append(position / sample_rate)
+            if len(starts) == batch_size:
+                yield batch, starts
+                starts = []
+            buffer[:window - hop] = buffer[hop:]
+            filled = carried = (window - hop) * 4
+            position += hop
+
+        # Zero-pad a trailing partial window if it holds enough new audio
+        if (filled - carried) // 4 >= min_tail:
+            buffer[filled // 4:] = 0.0
+            batch[len(starts)] = buffer
+            starts.append(position / sample_rate)
+        if starts:
+            yield batch[:len(starts)], starts
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+        errors.seek(0)
+        stderr = errors.read().decode("utf-8", "replace")
+        errors.close()
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {source}: {stderr.strip()}")
+
+
+def split_windows(signal, sample_rate=SAMPLE_RATE):
+    """
+    Cut a signal into consecutive WINDOW_SECONDS windows. A trailing partial window
+    of at least MIN_WINDOW_SECONDS is zero-padded, shorter tails are dropped.
+    Returns (windows array [n, samples], window start times in seconds).
+    """
+    window = int(WINDOW_SECONDS * sample_rate)
+    count = len(signal) // window
+    tail = len(signal) - count * window
+    if tail >= MIN_WINDOW_SECONDS * sample_rate:
+        count += 1
+    windows = np.zeros((count, window), dtype=np.float32)
+    for i in range(count):
+        chunk = signal[i * window:(i + 1) * window]
+        windows[i, :len(chunk)] = chunk
+    return windows, [i * WINDOW_SECONDS for i in range(count)]
+
+
+def activity_mask(windows, sample_rate=SAMPLE_RATE,
+                  min_rms_db=ACTIVITY_MIN_RMS_DB, min_tonality_db=ACTIVITY_MIN_TONALITY_DB):
+    """Boolean mask over a batch of windows [n, samples]: True where the window should be classified."""
+    frame = int(ACTIVITY_FRAME_SECONDS * sample_rate)
+    frames_per_window = windows.shape[1] // frame
+    frames = windows[:, :frames_per_window * frame].reshape(len(windows), frames_per_window, frame)
+
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=2))
+    rms_db = 20.0 * np.log10(np.maximum(rms, 1e-10))
+
+    spectrum = np.fft.rfft(frames * np.hanning(frame).astype(np.float32), axis=2)
+    power = np.square(np.abs(spectrum)) + 1e-12
+    log_power = np.log(power)
+    freqs = np.fft.rfftfreq(frame, 1.0 / sample_rate)
+    tonality_db = np.full(frames.shape[:2], -np.inf, dtype=np.float32)
+    for low, high in zip(ACTIVITY_BANDS_HZ[:-1], ACTIVITY_BANDS_HZ[1:]):
+        band = (freqs >= low) & (freqs < high)
+        ratio = np.log(power[:, :, band].mean(axis=2)) - log_power[:, :, band].mean(axis=2)
+        tonality_db = np.maximum(tonality_db, 10.0 * np.log10(np.e) * ratio)
+
+    return (rms_db.max(axis=1) >= min_rms_db) & (tonality_db.max(axis=1) >= min_tonality_db)
+
+
+def gate_batches(batches, stats, batch_size=BATCH_SIZE):
+    """
+    Drop inactive windows from (windows, starts) batches and repack the survivors
+    into full batches, so skipped windows also save classifier invocations.
+    `stats` is updated with the number of windows seen and skipped.
+    """
+    packed = None
+    packed_starts = []
+    for windows, starts in batches:
+        keep = activity_mask(windows)
+        stats["windows"] += len(starts)
+        stats["skipped"] += int(len(starts) - keep.sum())
+        for i in np.flatnonzero(keep):
+            if packed is None:
+                packed = np.zeros((batch_size, windows.shape[1]), dtype=np.float32)
+            packed[len(packed_starts)] = windows[i]
+            packed_starts.append(starts[i])
+            if len(packed_starts) == batch_size:
+                yield packed, packed_starts
+                packed_starts = []
+    if packed_starts:
+        yield packed[:len(packed_starts)], packed_starts
+
+
+def observe_batches(batches, observer):
+    """Pass (windows, starts) batches through unchanged after showing each one to observer."""
+    for windows, starts in batches:
+        observer(windows, starts)
+        yield windows, starts
+
+
+def count_species(detections):
+    """One occurrence per (window, species) detection, as the selection tables counted it."""
+    return dict(Counter(d["species"] for d in detections))
+
+
+# ## Detection timelines
+# A timeline keeps every detection above MIN_CONFIDENCE as parallel arrays
+# (start, end, species_id, confidence) plus the species names they index into,
+# so tags can be re-derived at any threshold >= MIN_CONFIDENCE or for any time
+# range without re-running the model.
+
+def build_timeline(detections):
+    species = sorted({d["species"] for d in detections})
+    species_ids = {name: i for i, name in enumerate(species)}
+    return {
+        "start": np.array([d["start"] for d in detections], dtype=np.float32),
+        "end": np.array([d["end"] for d in detections], dtype=np.float32),
+        "species_id": np.array([species_ids[d["species"]] for d in detections], dtype=np.int16),
+        "confidence": np.array([d["confidence"] for d in detections], dtype=np.float32),
+        "species": np.array(species, dtype=str),
+    }
+
+
+def timeline_to_bytes(timeline):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **timeline)
+    return buffer.getvalue()
+
+
+def timeline_from_bytes(data):
+    with np.load(io.BytesIO(data)) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def tags_from_timeline(timeline, threshold=MIN_CONFIDENCE, start=None, end=None):
+    """Species counts from a timeline at a confidence threshold, optionally within [start, end) seconds."""
+    mask = timeline["confidence"] >= threshold
+    if start is not None:
+        mask &= timeline["end"] > start
+    if end is not None:
+        mask &= timeline["start"] < end
+    counts = np.bincount(timeline["species_id"][mask].astype(np.int64), minlength=len(timeline["species"]))
+    return {str(timeline["species"][i]): int(n) for i, n in enumerate(counts) if n}
+
+
+def _score_worker(conn, birdnet_dir):
+    """Worker process: own single-threaded interpreter, scores window batches from the pipe."""
+    runner = BirdNetRunner(birdnet_dir, num_threads=1)
+    while True:
+        try:
+            windows = conn.recv()
+        except EOFError:
+            break
+        if windows is None:
+            break
+        try:
+            conn.send((True, runner.predict(windows)))
+        except Exception as e:
+            conn.send((False, repr(e)))
+    conn.close()
+
+
+class BirdNetRunner:
+    """
+    BirdNET TFLite interpreter and labels, loaded once and reused for every file.
+
+    With workers > 1 the interpreter lives in that many worker processes instead
+    and batches are sharded across them; results are still consumed in input order.
+    """
+
+    def __init__(self, birdnet_dir, num_threads=None, workers=0):
+        model_path = find_file(birdnet_dir, MODEL_FILENAME)
+        labels_path = find_file(birdnet_dir, LABELS_FILENAME)
+        self.interpreter = None
+        self.batch_size = None
+        self.workers = []
+        self.last_stats = None
+
+        if workers > 1:
+            # Lambda has no /dev/shm, so multiprocessing.Pool/Queue are unavailable; use Process + Pipe
+            ctx = multiprocessing.get_context("spawn")
+            for _ in range(workers):
+                parent_conn, child_conn = ctx.Pipe()
+                proc = ctx.Process(target=_score_worker, args=(child_conn, birdnet_dir), daemon=True)
+                proc.start()
+                child_conn.close()
+                self.workers.append((proc, parent_conn))
+            print(f"Started {workers} BirdNET worker processes")
+        else:
+            try:
+                import tflite_runtime.interpreter as tflite
+            except ImportError:
+                from tensorflow import lite as tflite
+            print(f"Loading BirdNET model from {model_path} ({num_threads} threads)")
+            self.interpreter = tflite.Interpreter(model_path=model_path, num_threads=num_threads)
+            self.interpreter.allocate_tensors()
+            self.input_index = self.interpreter.get_input_details()[0]["index"]
+            self.output_index = self.interpreter.get_output_details()[0]["index"]
+
+        # Labels are "Scientific name_Common name"
+        with open(labels_path, encoding="utf-8") as f:
+            self.labels = [line.strip() for line in f if line.strip()]
+        self.common_names = [label.split("_", 1)[-1] for label in self.labels]
+        self.scientific_names = [label.split("_", 1)[0] for label in self.labels]
+
+    def predict(self, windows):
+        """Per-class confidences for a batch of windows [n, samples]."""
+        if windows.shape[0] != self.batch_size:
+            self.interpreter.resize_tensor_input(self.input_index, list(windows.shape))
+            self.interpreter.allocate_tensors()
+            self.batch_size = windows.shape[0]
+        self.interpreter.set_tensor(self.input_index, np.ascontiguousarray(windows, dtype=np.float32))
+        self.interpreter.invoke()
+        logits = self.interpreter.get_tensor(self.output_index)
+        return 1.0 / (1.0 + np.exp(-SIGMOID_SENSITIVITY * np.clip(logits, -15.0, 15.0)))
+
+    def score_batches(self, batches):
+        """Yield (starts, scores) for each (windows, starts) batch, in input order."""
+        if not self.workers:
+            for windows, starts in batches:
+                yield starts, self.predict(windows)
+            return
+        try:
+            yield from self._score_batches_parallel(batches)
+        except Exception:
+            # A worker failed or died: drop the pool so the next call starts a fresh one
+            self.close()
+            for key, runner in list(_runners.items()):
+                if runner is self:
+                    del _runners[key]
+            raise
+
+    def _score_batches_parallel(self, batches):
+        # At most one batch in flight per worker: a worker is only sent work once its
+        # previous result has been read, so neither side can block on a full pipe.
+        batches = iter(batches)
+        idle = [conn for _, conn in self.workers]
+        in_flight = {}
+        finished = {}
+        sent = 0
+        next_index = 0
+        exhausted = False
+        while True:
+            while idle and not exhausted:
+                try:
+                    windows, starts = next(batches)
+                except StopIteration:
+                    exhausted = True
+                    break
+                conn = idle.pop()
+                conn.send(windows)  # pickled now, so the reusable stream buffer can be refilled
+                in_flight[conn] = (sent, list(starts))
+                sent += 1
+            if not in_flight:
+                return
+            for conn in wait(list(in_flight)):
+                index, starts = in_flight.pop(conn)
+                ok, payload = conn.recv()
+                if not ok:
+                    raise RuntimeError(f"BirdNET worker failed: {payload}")
+                finished[index] = (starts, payload)
+                idle.append(conn)
+            while next_index in finished:
+                yield finished.pop(next_index)
+                next_index += 1
+
+    def close(self):
+        for proc, conn in self.workers:
+            try:
+                conn.send(None)
+                conn.close()
+            except Exception:
+                pass
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+        self.workers = []
+
+    def analyze_batches(self, batches, min_confidence=MIN_CONFIDENCE, gate=ACTIVITY_GATE, observer=None):
+        """
+        Detections [{start, end, species, scientific_name, confidence}] for (windows, starts)
+        batches, ordered by window start and class index regardless of parallelism.
+        Window counts of the run, including those skipped by the activity gate, are kept in last_stats.
+        observer(windows, starts), if given, sees every decoded batch before the gate, e.g. to
+        build previews in the same decode pass; streamed windows are only valid during the call.
+        """
+        stats = {"windows": 0, "skipped": 0}
+        if observer is not None:
+            batches = observe_batches(batches, observer)
+        if gate:
+            batches = gate_batches(batches, stats)
+        detections = []
+        for starts, scores in self.score_batches(batches):
+            if not gate:
+                stats["windows"] += len(starts)
+            rows, cols = np.nonzero(scores >= min_confidence)
+            for row, col in zip(rows, cols):
+                detections.append({
+                    "start": starts[row],
+                    "end": starts[row] + WINDOW_SECONDS,
+                    "species": self.common_names[col],
+                    "scientific_name": self.scientific_names[col],
+                    "confidence": float(scores[row, col]),
+                })
+        self.last_stats = stats
+        print(f"Classified {stats['windows'] - stats['skipped']} of {stats['windows']} windows, "
+              f"{stats['skipped']} skipped by the activity gate")
+        return detections
+
+    def analyze_signal(self, signal, min_confidence=MIN_CONFIDENCE, observer=None):
+        windows, starts = split_windows(signal)
+        batches = ((windows[i:i + BATCH_SIZE], starts[i:i + BATCH_SIZE])
+                   for i in range(0, len(windows), BATCH_SIZE))
+        return self.analyze_batches(batches, min_confidence, observer=observer)
+
+    def analyze_stream(self, source, min_confidence=MIN_CONFIDENCE, observer=None):
+        """Analyze a path or URL while ffmpeg is still decoding it, in constant memory."""
+        return self.analyze_batches(stream_windows(source), min_confidence, observer=observer)
+
+    def analyze_file(self, path, min_confidence=MIN_CONFIDENCE, observer=None):
+        if shutil.which(FFMPEG):
+            return self.analyze_stream(path, min_confidence, observer)
+        return self.analyze_signal(load_audio(path), min_confidence, observer)
+
+
+def get_runner(birdnet_dir):
+    """Return the container-wide runner for a BirdNET directory, loading it on first use."""
+    if birdnet_dir not in _runners:
+        _runners[birdnet_dir] = BirdNetRunner(birdnet_dir, num_threads=THREADS, workers=WORKERS)
+    return _runners[birdnet_dir]
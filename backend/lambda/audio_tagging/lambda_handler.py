@@ -1,65 +1,169 @@
 import os
 import boto3
-import subprocess
+import hashlib
+import shutil
+import tempfile
 import zipfile
-import sys
-from collections import Counter
+from urllib.parse import unquote_plus
 
 os.environ["NUMBA_CACHE_DIR"] = "/tmp/numba_cache"
+# The prewarmed cache is compiled for a generic CPU; numba's cache index includes the
+# CPU name, so a host-specific target would miss on most of the Lambda fleet
+os.environ.setdefault("NUMBA_CPU_NAME", "generic")
+
+def prepare_numba_cache():
+    """Seed the writable numba cache with the kernels compiled at image build time."""
+    prewarmed = os.environ.get("PREWARMED_NUMBA_CACHE", "/opt/numba_cache")
+    cache_dir = os.environ["NUMBA_CACHE_DIR"]
+    if os.path.isdir(prewarmed) and not os.path.isdir(cache_dir):
+        shutil.copytree(prewarmed, cache_dir)
+        print(f"Copied prewarmed numba cache from {prewarmed}")
+
+# Must run before librosa (and so numba) is imported
+prepare_numba_cache()
+
+import birdnet_runner
+import previews
+import sqs_ingest
 
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table("BirdnetTaggedFiles")  # Use your DynamoDB table name
 
+# BirdNET-Analyzer baked into the image at build time (see Dockerfile)
+BIRDNET_BAKED_DIR = os.environ.get("BIRDNET_BAKED_DIR", "/opt/birdnet")
+# Written last into an extracted BirdNET directory, holds the zip's SHA-256
+BIRDNET_MARKER = ".birdnet_checksum"
+BIRDNET_ZIP_SHA256 = os.environ.get("BIRDNET_ZIP_SHA256")
+
+# Detection timelines: every detection is kept in S3 so tags can be re-derived at any
+# threshold >= BIRDNET_MIN_CONFIDENCE without re-running BirdNET
+TIMELINE_PREFIX = os.environ.get("TIMELINE_PREFIX", "timelines/")
+TAG_THRESHOLD = float(os.environ.get("TAG_THRESHOLD", str(birdnet_runner.MIN_CONFIDENCE)))
+
+# Waveform and spectrogram images, rendered from the same decode pass as BirdNET
+PREVIEW_PREFIX = os.environ.get("PREVIEW_PREFIX", "previews/")
+
+# Stream audio from a pre-signed URL through ffmpeg instead of downloading it first
+STREAM_AUDIO = os.environ.get("STREAM_AUDIO", "1") == "1"
+PRESIGNED_URL_EXPIRY = 3600
+
 def download_from_s3(bucket, key, dest):
     """Download a file from S3 to local path."""
     s3 = boto3.client('s3')
     os.makedirs(os.path.dirname(dest), exist_ok=True)
     s3.download_file(bucket, key, dest)
 
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def download_and_extract_zip_from_s3(bucket, key, extract_to):
-    """Download and extract a zip file from S3 to a target directory."""
+    """
+    Download and extract a zip file from S3 to a target directory.
+    Extraction goes to a temporary sibling directory which is renamed into place
+    only once complete, so an interrupted cold start never leaves a partial tree.
+    """
     s3 = boto3.client('s3')
     zip_path = '/tmp/birdnet_analyzer.zip'
     s3.download_file(bucket, key, zip_path)
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_to)
+    checksum = sha256_file(zip_path)
+    if BIRDNET_ZIP_SHA256 and checksum != BIRDNET_ZIP_SHA256:
+        os.remove(zip_path)
+        raise ValueError(f"Checksum mismatch for s3://{bucket}/{key}: {checksum}")
+
+    parent = os.path.dirname(os.path.abspath(extract_to))
+    staging_dir = tempfile.mkdtemp(prefix=".birdnet-", dir=parent)
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            zip_ref.extractall(staging_dir)
+        with open(os.path.join(staging_dir, BIRDNET_MARKER), 'w') as f:
+            f.write(checksum)
+        # A directory without the marker is a leftover from an interrupted extraction
+        if os.path.exists(extract_to):
+            shutil.rmtree(extract_to)
+        os.rename(staging_dir, extract_to)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    finally:
+        os.remove(zip_path)
+
+def analyze_audio(source, birdnet_dir, observer=None):
+    """
+    Run BirdNET in-process on a single audio file or URL, returning its detection timeline.
+    The model and labels are loaded from birdnet_dir once per container.
+    """
+    runner = birdnet_runner.get_runner(birdnet_dir)
+    detections = runner.analyze_file(source, observer=observer)
+    print(f"BirdNET returned {len(detections)} detections")
+    return birdnet_runner.build_timeline(detections)
+
+def timeline_key(audio_key):
+    return f"{TIMELINE_PREFIX}{audio_key}.npz"
+
+def save_timeline(bucket, audio_key, timeline):
+    """Store a timeline next to the audio in S3 and return its s3:// URL."""
+    key = timeline_key(audio_key)
+    s3 = boto3.client('s3')
+    s3.put_object(Bucket=bucket, Key=key, Body=birdnet_runner.timeline_to_bytes(timeline),
+                  ContentType='application/octet-stream')
+    return f"s3://{bucket}/{key}"
+
+def preview_keys(audio_key):
+    # The full file name, extension included, so bird.wav and bird.flac do not share previews
+    name = os.path.basename(audio_key)
+    ext = previews.preview_extension()
+    return {
+        "waveform_url": f"{PREVIEW_PREFIX}{name}-waveform.{ext}",
+        "spectrogram_url": f"{PREVIEW_PREFIX}{name}-spectrogram.{ext}",
+    }
+
+def save_previews(bucket, audio_key, preview):
+    """Render and upload the waveform and spectrogram; returns {waveform_url, spectrogram_url}."""
+    if preview.empty:
+        print(f"No audio decoded for previews of {audio_key}")
+        return {}
+    s3 = boto3.client('s3')
+    keys = preview_keys(audio_key)
+    images = {"waveform_url": preview.render_waveform(), "spectrogram_url": preview.render_spectrogram()}
+    for field, image in images.items():
+        body, content_type = previews.encode_image(image)
+        s3.put_object(Bucket=bucket, Key=keys[field], Body=body, ContentType=content_type)
+    return {field: f"s3://{bucket}/{key}" for field, key in keys.items()}
+
+def existing_previews(bucket, audio_key):
+    """Preview URLs for an already analyzed file, if its previews were rendered."""
+    s3 = boto3.client('s3')
+    keys = preview_keys(audio_key)
+    try:
+        s3.head_object(Bucket=bucket, Key=keys["spectrogram_url"])
+    except s3.exceptions.ClientError:
+        return {}
+    return {field: f"s3://{bucket}/{key}" for field, key in keys.items()}
+
+def load_timeline(bucket, audio_key):
+    s3 = boto3.client('s3')
+    body = s3.get_object(Bucket=bucket, Key=timeline_key(audio_key))['Body'].read()
+    return birdnet_runner.timeline_from_bytes(body)
 
-def analyze_audio(input_wav_path, output_dir, birdnet_dir):
+def retag_audio(bucket, audio_key, threshold, start=None, end=None):
     """
-    Run BirdNET-Analyzer CLI on a single audio file, returning a dict {species_name: count}.
-    Assumes all dependencies and resources are available in birdnet_dir.
+    Re-derive tags for an already analyzed file from its stored timeline.
+    With no time range the metadata item is rewritten; a time range only returns the counts.
     """
-    # Add BirdNET directory to sys.path if not already present
-    if birdnet_dir not in sys.path:
-        sys.path.insert(0, birdnet_dir)
-    # Ensure output dir exists
-    os.makedirs(output_dir, exist_ok=True)
-    input_dir = os.path.dirname(input_wav_path)
-    cmd = [
-        "python3", "-m", "birdnet_analyzer.analyze",
-        input_dir, "-o", output_dir,
-    ]
-    print(f"Running command: {' '.join(cmd)}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    print(result.stdout)
-    print(result.stderr)
-    # Parse tags from output
-    species_counter = Counter()
-    for fname in os.listdir(output_dir):
-        if fname.endswith(".txt"):
-            with open(os.path.join(output_dir, fname)) as f:
-                for line in f:
-                    if line.startswith("#") or not line.strip():
-                        continue
-                    parts = line.strip().split('\t')
-                    if len(parts) > 7:
-                        species_name = parts[7]
-                        if species_name.strip().lower() == "common name":
-                            continue
-                        species_counter[species_name] += 1
-    return dict(species_counter)
-
-def write_tags_to_dynamodb(base_name, file_type, s3_url, tags, table):
+    tags = birdnet_runner.tags_from_timeline(load_timeline(bucket, audio_key), threshold, start, end)
+    if start is None and end is None:
+        base_name = os.path.splitext(os.path.basename(audio_key))[0]
+        file_type = os.path.splitext(audio_key)[1].lstrip('.').lower()
+        write_tags_to_dynamodb(base_name, file_type, f"s3://{bucket}/{audio_key}", tags, table,
+                               timeline_url=f"s3://{bucket}/{timeline_key(audio_key)}",
+                               preview_urls=existing_previews(bucket, audio_key))
+    return tags
+
+def write_tags_to_dynamodb(base_name, file_type, s3_url, tags, table, timeline_url=None, preview_urls=None):
     """Write result to DynamoDB."""
     item = {
         "file_id": base_name,
@@ -67,48 +171,100 @@ def write_tags_to_dynamodb(base_name, file_type, s3_url, tags, table):
         "original_url": s3_url,
         "tags": {k: int(v) for k, v in tags.items()},
     }
+    if timeline_url:
+        item["timeline_url"] = timeline_url
+    item.update(preview_urls or {})
     table.put_item(Item=item)
     print(f"Wrote result to DynamoDB: {item}")
     return item
 
 def prepare_birdnet_dir(birdnet_bucket, birdnet_zip_key, birdnet_dir):
-    """Download and extract BirdNET-Analyzer if not already present."""
-    if not os.path.exists(birdnet_dir):
+    """
+    Return the BirdNET-Analyzer directory to use: the copy baked into the image if
+    there is one, otherwise birdnet_dir, downloaded and extracted if not complete.
+    """
+    if os.path.exists(os.path.join(BIRDNET_BAKED_DIR, BIRDNET_MARKER)):
+        return BIRDNET_BAKED_DIR
+    if not os.path.exists(os.path.join(birdnet_dir, BIRDNET_MARKER)):
         print("Downloading and extracting BirdNET-Analyzer...")
         download_and_extract_zip_from_s3(birdnet_bucket, birdnet_zip_key, birdnet_dir)
+    return birdnet_dir
 
 def prepare_audio_file(audio_bucket, audio_key, input_dir):
-    """Download the input audio file from S3 to the specified directory."""
+    """Download the input audio file from S3 into its own working directory."""
     os.makedirs(input_dir, exist_ok=True)
-    audio_local_path = os.path.join(input_dir, "input.wav")
+    # Keep the original name so the decoder can tell the container format
+    audio_local_path = os.path.join(input_dir, os.path.basename(audio_key))
     download_from_s3(audio_bucket, audio_key, audio_local_path)
-    print("Completed audio download")
+    print(f"Completed audio download: {audio_key}")
     return audio_local_path
 
+def process_record(record, birdnet_dir, work_root):
+    """Download, analyze and store one S3 record, using a private working directory."""
+    audio_bucket = record["s3"]["bucket"]["name"]
+    audio_key = unquote_plus(record["s3"]["object"]["key"])
+    preview = previews.AudioPreview(birdnet_runner.SAMPLE_RATE)
+    if STREAM_AUDIO and shutil.which(birdnet_runner.FFMPEG):
+        # Analysis starts on the first decoded windows, memory stays constant
+        s3 = boto3.client('s3')
+        url = s3.generate_presigned_url('get_object', Params={'Bucket': audio_bucket, 'Key': audio_key},
+                                        ExpiresIn=PRESIGNED_URL_EXPIRY)
+        timeline = analyze_audio(url, birdnet_dir, preview)
+    else:
+        work_dir = tempfile.mkdtemp(prefix="audio-", dir=work_root)
+        try:
+            audio_local_path = prepare_audio_file(audio_bucket, audio_key, work_dir)
+            timeline = analyze_audio(audio_local_path, birdnet_dir, preview)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    tags = birdnet_runner.tags_from_timeline(timeline, TAG_THRESHOLD)
+    print(f"Species counts for {audio_key}: {tags}")
+    timeline_url = save_timeline(audio_bucket, audio_key, timeline)
+    try:
+        preview_urls = save_previews(audio_bucket, audio_key, preview)
+    except Exception as e:
+        # Previews are cosmetic, a failure must not lose the tags
+        print(f"Failed to render previews for {audio_key}: {e}")
+        preview_urls = {}
+
+    base_name = os.path.splitext(os.path.basename(audio_key))[0]
+    file_type = os.path.splitext(audio_key)[1].lstrip('.').lower()
+    s3_url = f"s3://{audio_bucket}/{audio_key}"
+    return write_tags_to_dynamodb(base_name, file_type, s3_url, tags, table, timeline_url, preview_urls)
+
 # --- Main Lambda Handler ---
 def lambda_handler(event, context):
+    # Re-threshold an analyzed file from its timeline:
+    # {"retag": {"bucket": ..., "key": ..., "threshold": 0.5, "start": 0, "end": 60}}
+    if "retag" in event:
+        request = event["retag"]
+        return retag_audio(request["bucket"], request["key"], float(request["threshold"]),
+                           request.get("start"), request.get("end"))
+
     birdnet_bucket = "birdnet-model-178"
     birdnet_zip_key = "birdnet_analyzer.zip"
     birdnet_dir = "/tmp/birdnet"
-    input_dir = "/tmp/input_audio"
-    output_dir = "/tmp/output"
+    work_root = "/tmp/input_audio"
 
-    # 1. Ensure BirdNET-Analyzer is in /tmp/birdnet
-    prepare_birdnet_dir(birdnet_bucket, birdnet_zip_key, birdnet_dir)
+    # 1. Ensure BirdNET-Analyzer is baked into the image or extracted to /tmp/birdnet
+    birdnet_dir = prepare_birdnet_dir(birdnet_bucket, birdnet_zip_key, birdnet_dir)
+    os.makedirs(work_root, exist_ok=True)
 
-    # 2. Parse event for audio file info and download it
-    record = event["Records"][0]
-    audio_bucket = record["s3"]["bucket"]["name"]
-    audio_key = record["s3"]["object"]["key"]
-    audio_local_path = prepare_audio_file(audio_bucket, audio_key, input_dir)
+    # Uploads buffered through SQS: one warm model for the whole batch, failed messages retried alone
+    if sqs_ingest.is_sqs_event(event):
+        return sqs_ingest.process_sqs_event(event, lambda record: process_record(record, birdnet_dir, work_root))
 
-    # 3. Analyze audio file and get species tag counts
-    tags = analyze_audio(audio_local_path, output_dir, birdnet_dir)
-    print(f"Species counts: {tags}")
+    # 2. Analyze every record with the same loaded model; each file gets its own
+    #    working directory that is removed afterwards, so nothing leaks between invocations
+    items = []
+    failures = []
+    for record in event["Records"]:
+        try:
+            items.append(process_record(record, birdnet_dir, work_root))
+        except Exception as e:
+            print(f"Failed to process {record['s3']['object']['key']}: {e}")
+            failures.append(record["s3"]["object"]["key"])
 
-    # 4. Store in DynamoDB
-    base_name = os.path.splitext(os.path.basename(audio_key))[0]
-    file_type = os.path.splitext(audio_key)[1].lstrip('.').lower()
-    s3_url = f"s3://{audio_bucket}/{audio_key}"
-    item = write_tags_to_dynamodb(base_name, file_type, s3_url, tags, table)
-    return item
+    if failures:
+        raise RuntimeError(f"Audio tagging failed for {failures}")
+    return items
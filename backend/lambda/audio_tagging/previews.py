@@ -0,0 +1,190 @@
+"""
+Waveform and mel-spectrogram preview images for audio files.
+
+AudioPreview is passed to BirdNetRunner as the batch observer, so it sees every
+decoded window in the same pass that feeds BirdNET and never decodes the audio
+again. It reduces the signal to bins as it arrives (min/max for the waveform, mel
+band power for the spectrogram) and folds them into a fixed number of columns,
+halving their time resolution whenever they fill up, so memory stays constant
+however long the recording is. Both images are rendered with Pillow once analysis
+has finished.
+"""
+import io
+import os
+
+import numpy as np
+from PIL import Image, ImageDraw, features
+
+PREVIEW_WIDTH = int(os.environ.get("PREVIEW_WIDTH", "512"))
+WAVEFORM_HEIGHT = int(os.environ.get("WAVEFORM_HEIGHT", "96"))
+SPECTROGRAM_HEIGHT = int(os.environ.get("SPECTROGRAM_HEIGHT", "128"))
+# "webp" falls back to PNG when this Pillow build has no WebP support
+PREVIEW_FORMAT = os.environ.get("PREVIEW_FORMAT", "webp")
+
+# One bin = two 1024-sample FFT frames (~43 ms at 48 kHz)
+FFT_SIZE = 1024
+FRAMES_PER_BIN = 2
+N_MELS = 64
+MEL_RANGE_HZ = (150.0, 15000.0)
+DYNAMIC_RANGE_DB = 80.0
+
+WAVEFORM_COLOR = (30, 90, 160)
+BACKGROUND_COLOR = (255, 255, 255)
+# Dark blue -> teal -> yellow, interpolated over the normalised dB range
+COLORMAP = np.array([(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)], dtype=np.float32)
+
+
+def hz_to_mel(hz):
+    return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+
+def mel_to_hz(mel):
+    return 700.0 * (10.0 ** (mel / 2595.0) - 1.0)
+
+
+def mel_filterbank(sample_rate, n_fft=FFT_SIZE, n_mels=N_MELS, fmin=MEL_RANGE_HZ[0], fmax=MEL_RANGE_HZ[1]):
+    """Triangular mel filters [n_mels, n_fft // 2 + 1] (HTK mel scale)."""
+    hz = mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(min(fmax, sample_rate / 2)), n_mels + 2))
+    freqs = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+    lower = (freqs[None, :] - hz[:-2, None]) / (hz[1:-1, None] - hz[:-2, None])
+    upper = (hz[2:, None] - freqs[None, :]) / (hz[2:, None] - hz[1:-1, None])
+    return np.maximum(0.0, np.minimum(lower, upper)).astype(np.float32)
+
+
+class AudioPreview:
+    """Accumulates per-column waveform extents and mel power from (windows, starts) batches."""
+
+    def __init__(self, sample_rate=48000, max_columns=2 * PREVIEW_WIDTH):
+        self.sample_rate = sample_rate
+        self.bin_samples = FFT_SIZE * FRAMES_PER_BIN
+        self.filters = mel_filterbank(sample_rate)
+        self.hann = np.hanning(FFT_SIZE).astype(np.float32)
+        self.position = 0   # samples consumed so far; overlapping windows only add what is new
+        self.pending = np.zeros(0, dtype=np.float32)
+        # Columns of bins_per_column bins each; max_columns is even so pairs can be merged
+        self.max_columns = max_columns + max_columns % 2
+        self.bins_per_column = 1
+        self.columns = 0
+        self.extents = np.zeros((self.max_columns, 2), dtype=np.float32)
+        self.mels = np.zeros((self.max_columns, N_MELS), dtype=np.float32)
+        # The column being filled: running min/max, mel power sum and bin count
+        self.partial_extent = None
+        self.partial_mel = np.zeros(N_MELS, dtype=np.float32)
+        self.partial_bins = 0
+
+    def __call__(self, windows, starts):
+        for window, start in zip(windows, starts):
+            offset = int(round(start * self.sample_rate))
+            new = window[max(0, self.position - offset):]
+            if not len(new):
+                continue
+            self.position = offset + len(window)
+            self.pending = np.concatenate([self.pending, new])
+        self._reduce()
+
+    def _reduce(self):
+        count = len(self.pending) // self.bin_samples
+        if not count:
+            return
+        bins = self.pending[:count * self.bin_samples].reshape(count, self.bin_samples)
+        self.pending = self.pending[count * self.bin_samples:].copy()
+        extents = np.stack([bins.min(axis=1), bins.max(axis=1)], axis=1)
+        frames = bins.reshape(count, FRAMES_PER_BIN, FFT_SIZE) * self.hann
+        power = np.square(np.abs(np.fft.rfft(frames, axis=2))).mean(axis=1)
+        self._fold(extents, (power @ self.filters.T).astype(np.float32))
+
+    def _fold(self, extents, mels):
+        """Add bins to the partial column, storing it each time it holds bins_per_column bins."""
+        while len(extents):
+            take = self.bins_per_column - self.partial_bins
+            chunk = extents[:take]
+            extent = np.array([chunk[:, 0].min(), chunk[:, 1].max()], dtype=np.float32)
+            if self.partial_extent is not None:
+                extent = np.array([min(extent[0], self.partial_extent[0]),
+                                   max(extent[1], self.partial_extent[1])], dtype=np.float32)
+            self.partial_extent = extent
+            self.partial_mel += mels[:take].sum(axis=0)
+            self.partial_bins += len(chunk)
+            extents, mels = extents[take:], mels[take:]
+            if self.partial_bins < self.bins_per_column:
+                continue
+            if self.columns == self.max_columns:
+                # Full: merge neighbouring columns, halving the time resolution; the partial
+                # column is then only half full and keeps collecting
+                self._merge_columns()
+            else:
+                self._store_partial()
+
+    def _merge_columns(self):
+        pairs = self.extents.reshape(-1, 2, 2)
+        half = self.max_columns // 2
+        self.extents[:half] = np.stack([pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)], axis=1)
+        self.mels[:half] = self.mels.reshape(half, 2, N_MELS).mean(axis=1)
+        self.columns = half
+        self.bins_per_column *= 2
+
+    def _store_partial(self):
+        self.extents[self.columns] = self.partial_extent
+        self.mels[self.columns] = self.partial_mel / self.partial_bins
+        self.columns += 1
+        self.partial_extent = None
+        self.partial_mel[:] = 0.0
+        self.partial_bins = 0
+
+    def _stored(self):
+        """(extents, mels) of all columns, including the partial one."""
+        extents, mels = self.extents[:self.columns], self.mels[:self.columns]
+        if self.partial_bins:
+            extents = np.vstack([extents, self.partial_extent[None]])
+            mels = np.vstack([mels, (self.partial_mel / self.partial_bins)[None]])
+        return extents, mels
+
+    @property
+    def empty(self):
+        return not self.columns and not self.partial_bins
+
+    def _columns(self, count, width):
+        """Start index of the stored columns that make up each of `width` image columns."""
+        return np.linspace(0, count, width + 1).astype(int)[:-1]
+
+    def render_waveform(self, width=PREVIEW_WIDTH, height=WAVEFORM_HEIGHT):
+        extents, _ = self._stored()
+        columns = self._columns(len(extents), width)
+        lows = np.clip(np.minimum.reduceat(extents[:, 0], columns), -1.0, 1.0)
+        highs = np.clip(np.maximum.reduceat(extents[:, 1], columns), -1.0, 1.0)
+        # Scale to the loudest peak so quiet recordings are still readable
+        peak = max(float(np.abs(extents).max()), 1e-3)
+        image = Image.new("RGB", (width, height), BACKGROUND_COLOR)
+        draw = ImageDraw.Draw(image)
+        middle = (height - 1) / 2.0
+        for x, (low, high) in enumerate(zip(lows / peak, highs / peak)):
+            draw.line([(x, middle - high * middle), (x, middle - low * middle)], fill=WAVEFORM_COLOR)
+        return image
+
+    def render_spectrogram(self, width=PREVIEW_WIDTH, height=SPECTROGRAM_HEIGHT):
+        _, mels = self._stored()
+        columns = self._columns(len(mels), width)
+        counts = np.diff(np.append(columns, len(mels)))
+        power = np.add.reduceat(mels, columns, axis=0) / np.maximum(counts, 1)[:, None]
+        db = 10.0 * np.log10(np.maximum(power, 1e-10))
+        level = np.clip((db - (db.max() - DYNAMIC_RANGE_DB)) / DYNAMIC_RANGE_DB, 0.0, 1.0)
+        # [width, mels] -> rows of mel bands, low frequencies at the bottom
+        level = np.flipud(level.T)
+        anchors = np.linspace(0.0, 1.0, len(COLORMAP))
+        rgb = np.stack([np.interp(level, anchors, COLORMAP[:, c]) for c in range(3)], axis=-1)
+        image = Image.fromarray(rgb.astype(np.uint8))
+        return image.resize((width, height), Image.Resampling.BILINEAR)
+
+
+def preview_extension(fmt=PREVIEW_FORMAT):
+    return "webp" if fmt == "webp" and features.check("webp") else "png"
+
+
+def encode_image(image, fmt=PREVIEW_FORMAT):
+    """Encode a preview image; returns (bytes, content type)."""
+    buffer = io.BytesIO()
+    if preview_extension(fmt) == "webp":
+        image.save(buffer, format="WEBP", quality=80)
+        return buffer.getvalue(), "image/webp"
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue(), "image/png"
@@ -0,0 +1,50 @@
+import numpy as np
+
+import birdnet_runner
+
+SAMPLE_RATE = birdnet_runner.SAMPLE_RATE
+WINDOW = int(birdnet_runner.WINDOW_SECONDS * SAMPLE_RATE)
+TIME = np.arange(WINDOW) / SAMPLE_RATE
+
+
+def white_noise(count, sigma=0.05, seed=0):
+    return np.random.default_rng(seed).normal(0.0, sigma, (count, WINDOW)).astype(np.float32)
+
+
+def test_faint_tone_in_noise_is_classified():
+    # Whole-band flatness dropped this: the tone is well below the broadband noise
+    tone = (0.02 * np.sin(2 * np.pi * 4000 * TIME)).astype(np.float32)
+    assert birdnet_runner.activity_mask(white_noise(8) + tone).all()
+
+
+def test_low_owl_like_call_is_classified():
+    hoot = (0.02 * np.sin(2 * np.pi * 400 * TIME)).astype(np.float32)
+    assert birdnet_runner.activity_mask(white_noise(8, seed=1) + hoot).all()
+
+
+def test_brief_sweep_in_noise_is_classified():
+    windows = white_noise(8, seed=2)
+    length = int(0.15 * SAMPLE_RATE)
+    t = np.arange(length) / SAMPLE_RATE
+    sweep = 0.04 * np.sin(2 * np.pi * (3000 * t + 6000 * t ** 2))
+    windows[:, SAMPLE_RATE:SAMPLE_RATE + length] += sweep.astype(np.float32)
+    assert birdnet_runner.activity_mask(windows).all()
+
+
+def test_silence_is_skipped():
+    assert not birdnet_runner.activity_mask(np.zeros((4, WINDOW), dtype=np.float32)).any()
+
+
+def test_most_noise_only_windows_are_skipped():
+    assert birdnet_runner.activity_mask(white_noise(64, seed=3)).mean() < 0.4
+
+
+def test_gate_batches_repacks_survivors():
+    tone = (0.02 * np.sin(2 * np.pi * 4000 * TIME)).astype(np.float32)
+    windows = np.zeros((6, WINDOW), dtype=np.float32)
+    windows[[1, 4]] += white_noise(2, seed=4) + tone
+    stats = {"windows": 0, "skipped": 0}
+    batches = list(birdnet_runner.gate_batches([(windows, [i * 3.0 for i in range(6)])], stats, batch_size=4))
+
+    assert stats == {"windows": 6, "skipped": 4}
+    assert [starts for _, starts in batches] == [[3.0, 12.0]]
@@ -0,0 +1,56 @@
+import numpy as np
+
+import previews
+
+SAMPLE_RATE = 48000
+WINDOW = 3 * SAMPLE_RATE
+
+
+def feed(preview, signal, batch_size=16):
+    """Hand a signal to the preview in (windows, starts) batches, as BirdNetRunner does."""
+    count = len(signal) // WINDOW
+    windows = signal[:count * WINDOW].reshape(count, WINDOW)
+    starts = [i * 3.0 for i in range(count)]
+    for i in range(0, count, batch_size):
+        preview(windows[i:i + batch_size], starts[i:i + batch_size])
+
+
+def test_short_audio_keeps_every_bin():
+    signal = np.random.default_rng(0).normal(0, 0.1, 4 * WINDOW).astype(np.float32)
+    preview = previews.AudioPreview(SAMPLE_RATE)
+    feed(preview, signal)
+
+    extents, _ = preview._stored()
+    bins = len(signal) // preview.bin_samples
+    expected = signal[:bins * preview.bin_samples].reshape(bins, -1)
+    assert preview.bins_per_column == 1
+    assert np.allclose(extents[:, 0], expected.min(axis=1))
+    assert np.allclose(extents[:, 1], expected.max(axis=1))
+
+
+def test_long_audio_stays_within_the_column_budget():
+    rng = np.random.default_rng(1)
+    signal = rng.normal(0, 0.01, 40 * WINDOW).astype(np.float32)
+    # A loud click three quarters of the way in
+    click = int(0.75 * len(signal))
+    signal[click] = 0.9
+    preview = previews.AudioPreview(SAMPLE_RATE, max_columns=64)
+    feed(preview, signal)
+
+    extents, mels = preview._stored()
+    bins = len(signal) // preview.bin_samples
+    assert preview.columns <= 64 and len(extents) <= 65
+    assert preview.extents.shape == (64, 2)
+    assert preview.columns * preview.bins_per_column + preview.partial_bins == bins
+    assert extents[:, 1].max() == np.float32(0.9)
+    assert abs(int(np.argmax(extents[:, 1])) / len(extents) - 0.75) < 0.05
+    assert mels.shape == (len(extents), previews.N_MELS)
+
+
+def test_renders_at_the_requested_size():
+    signal = np.random.default_rng(2).normal(0, 0.1, 20 * WINDOW).astype(np.float32)
+    preview = previews.AudioPreview(SAMPLE_RATE, max_columns=100)
+    feed(preview, signal)
+
+    assert preview.render_waveform(width=128, height=32).size == (128, 32)
+    assert preview.render_spectrogram(width=128, height=48).size == (128, 48)
@@ -0,0 +1,41 @@
+import os
+import stat
+import sys
+import textwrap
+
+import numpy as np
+import pytest
+
+import birdnet_runner
+
+
+def fake_ffmpeg(tmp_path, seconds, stderr_bytes, exit_code=0):
+    """An ffmpeg stand-in that floods stderr before writing `seconds` of f32le PCM."""
+    script = tmp_path / "ffmpeg"
+    script.write_text(textwrap.dedent(f"""\
+        #!{sys.executable}
+        import sys
+        sys.stderr.write("w" * {stderr_bytes})
+        sys.stderr.flush()
+        samples = int({seconds} * {birdnet_runner.SAMPLE_RATE})
+        sys.stdout.buffer.write(bytes(4 * samples))
+        sys.exit({exit_code})
+    """))
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    return str(script)
+
+
+def test_verbose_stderr_does_not_block_decoding(tmp_path, monkeypatch):
+    # Far more than a pipe buffer, written before any audio
+    monkeypatch.setattr(birdnet_runner, "FFMPEG", fake_ffmpeg(tmp_path, 7, 1 << 20))
+    batches = list(birdnet_runner.stream_windows("input.wav", batch_size=2))
+
+    starts = [start for _, batch_starts in batches for start in batch_starts]
+    assert starts == [0.0, 3.0, 6.0]
+    assert all(np.all(windows == 0.0) for windows, _ in batches)
+
+
+def test_ffmpeg_failure_reports_stderr(tmp_path, monkeypatch):
+    monkeypatch.setattr(birdnet_runner, "FFMPEG", fake_ffmpeg(tmp_path, 0, 100, exit_code=1))
+    with pytest.raises(RuntimeError, match="w" * 100):
+        list(birdnet_runner.stream_windows("input.wav"))
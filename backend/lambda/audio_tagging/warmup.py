@@ -0,0 +1,43 @@
+"""
+Build-time warm-up for the audio image.
+
+Runs representative decode, resample and spectrogram calls so numba compiles the
+librosa/resampy kernels once and caches them in NUMBA_CACHE_DIR. The Dockerfile
+points that at /opt/numba_cache; lambda_handler copies it to /tmp at cold start.
+NUMBA_CPU_NAME=generic makes the cache usable on any x86 host rather than only on
+the build machine's CPU.
+"""
+import os
+import tempfile
+
+import numpy as np
+import soundfile as sf
+import librosa
+
+import birdnet_runner
+
+
+def main():
+    cache_dir = os.environ.get("NUMBA_CACHE_DIR")
+    if not cache_dir:
+        raise SystemExit("NUMBA_CACHE_DIR must be set")
+    if os.environ.get("NUMBA_CPU_NAME") != "generic":
+        raise SystemExit("NUMBA_CPU_NAME must be 'generic' so the cache matches at runtime")
+
+    # A few seconds of a bird-like tone at common recorder sample rates
+    for sample_rate in (22050, 44100, 48000):
+        t = np.arange(int(sample_rate * 4)) / sample_rate
+        tone = (0.1 * np.sin(2 * np.pi * 3000 * t)).astype(np.float32)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for ext in ("wav", "flac"):
+                path = os.path.join(tmp_dir, f"warmup.{ext}")
+                sf.write(path, tone, sample_rate)
+                signal = birdnet_runner.load_audio(path)
+        librosa.resample(tone, orig_sr=sample_rate, target_sr=birdnet_runner.SAMPLE_RATE, res_type="kaiser_best")
+
+    librosa.feature.melspectrogram(y=signal, sr=birdnet_runner.SAMPLE_RATE)
+    print(f"Numba cache written to {cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
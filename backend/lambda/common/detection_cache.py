@@ -0,0 +1,82 @@
+"""
+Detection cache shared by the thumbnail_tagging, Query4 and query4_latest images.
+
+Tags are stored per content key (S3 ETag plus size, or a hash of uploaded bytes)
+under the version of everything that produced them: the model weights, named by
+their S3 ETag or a hash of the file so retraining in place invalidates entries,
+plus the frame aggregation for videos. An entry stored under another version is
+a miss. A small LRU in front of DynamoDB serves repeats within a warm container.
+
+The images copy this file next to their handler, so they are built from
+backend/lambda (see their Dockerfiles).
+"""
+import functools
+import hashlib
+import os
+from collections import OrderedDict
+
+import boto3
+
+CACHE_TABLE_NAME = os.environ.get("DETECTION_CACHE_TABLE", "BirdnetDetectionCache")
+CACHE_MAX_ENTRIES = int(os.environ.get("DETECTION_CACHE_SIZE", "1024"))
+
+cache_table = boto3.resource("dynamodb").Table(CACHE_TABLE_NAME)
+entries = OrderedDict()
+
+
+@functools.lru_cache(maxsize=None)
+def s3_weights_version(bucket, key):
+    """
+    Version of model weights kept in S3: their ETag, which changes whenever the object
+    is replaced. Looked up once per container, like the weights downloaded from it.
+    """
+    etag = boto3.client("s3").head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+    return f"s3://{bucket}/{key}@{etag}"
+
+
+@functools.lru_cache(maxsize=None)
+def file_weights_version(path):
+    """Version of model weights baked into the image: a hash of the file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return "sha256:" + digest.hexdigest()
+
+
+def cache_version(model_version, aggregation=None):
+    """Version an entry is stored under; video counts also depend on how frames are aggregated."""
+    return model_version if aggregation is None else f"{model_version}|{aggregation}"
+
+
+def _remember(content_key, entry):
+    entries[content_key] = entry
+    entries.move_to_end(content_key)
+    while len(entries) > CACHE_MAX_ENTRIES:
+        entries.popitem(last=False)
+
+
+def get_cached_tags(content_key, version):
+    entry = entries.get(content_key)
+    if entry is None:
+        try:
+            item = cache_table.get_item(Key={"content_key": content_key}).get("Item")
+        except Exception as e:
+            print(f"Detection cache lookup failed: {e}")
+            return None
+        if item is None:
+            return None
+        entry = (item.get("model_version"), {k: int(v) for k, v in item.get("tags", {}).items()})
+    if entry[0] != version:
+        return None
+    _remember(content_key, entry)
+    return dict(entry[1])
+
+
+def put_cached_tags(content_key, tags, version):
+    tags = {k: int(v) for k, v in tags.items()}
+    _remember(content_key, (version, tags))
+    try:
+        cache_table.put_item(Item={"content_key": content_key, "model_version": version, "tags": tags})
+    except Exception as e:
+        print(f"Detection cache write failed: {e}")
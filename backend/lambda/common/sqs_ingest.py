@@ -0,0 +1,162 @@
+"""
+SQS-buffered ingest.
+
+Instead of invoking the Lambda once per S3 notification, uploads can be routed
+S3 -> SQS -> Lambda. The event source mapping hands each container a batch of
+messages, waiting up to its batching window to fill it, so a burst of uploads
+is processed by a few warm containers that load their models once for many
+objects. Every message is processed independently and the failed ones are
+reported in batchItemFailures, so only those are retried (and end up in the
+queue's dead-letter queue after its maxReceiveCount).
+
+The queue, its dead-letter queue and the event source mapping are deploy-time
+settings (see "SQS ingest" in the README), so this module only handles the
+batches. It is copied into the thumbnail_tagging, audio_tagging and
+query4_latest images, which are built from backend/lambda (see their
+Dockerfiles). MemoryQueue is an in-process stand-in for SQS with the same
+batching and retry behaviour, for running a handler locally.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+def is_sqs_event(event):
+    records = event.get("Records") or []
+    return bool(records) and all(r.get("eventSource") == "aws:sqs" for r in records)
+
+
+def s3_records(message):
+    """S3 event records carried by one SQS message (directly or through an SNS topic)."""
+    body = json.loads(message["body"])
+    if "Message" in body and "Records" not in body:
+        body = json.loads(body["Message"])
+    # s3:TestEvent, sent when the notification is configured, carries no records
+    return body.get("Records", [])
+
+
+def process_sqs_event(event, handle_record):
+    """
+    Call handle_record(s3_record) for every S3 record in an SQS batch and return the
+    partial batch response. A message fails if any of its records raised.
+    """
+    failures = []
+    for message in event["Records"]:
+        try:
+            for record in s3_records(message):
+                handle_record(record)
+        except Exception as e:
+            print(f"Failed to process message {message['messageId']}: {e}")
+            failures.append({"itemIdentifier": message["messageId"]})
+    print(f"Processed {len(event['Records']) - len(failures)}/{len(event['Records'])} messages")
+    return {"batchItemFailures": failures}
+
+
+def s3_event_body(bucket, key, etag=None, size=None):
+    """Body of an S3 ObjectCreated notification for one object, as S3 sends it to SQS."""
+    obj = {"key": key}
+    if etag is not None:
+        obj["eTag"] = etag
+    if size is not None:
+        obj["size"] = size
+    return json.dumps({"Records": [{
+        "eventSource": "aws:s3",
+        "eventName": "ObjectCreated:Put",
+        "s3": {"bucket": {"name": bucket}, "object": obj},
+    }]})
+
+
+class MemoryQueue:
+    """
+    In-process stand-in for an SQS queue feeding a Lambda. receive() builds the same
+    event the event source mapping would; failed messages become visible again after
+    visibility_timeout and move to dead_letters after max_receive_count receives.
+    """
+
+    def __init__(self, batch_size=10, batch_window=5,
+                 visibility_timeout=0, max_receive_count=3):
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.visibility_timeout = visibility_timeout
+        self.max_receive_count = max_receive_count
+        self.messages = OrderedDict()
+        self.dead_letters = []
+        self.condition = threading.Condition()
+
+    def send(self, body):
+        message_id = uuid.uuid4().hex
+        with self.condition:
+            self.messages[message_id] = {"body": body, "receive_count": 0, "visible_at": 0.0}
+            self.condition.notify_all()
+        return message_id
+
+    def send_s3_event(self, bucket, key, etag=None, size=None):
+        return self.send(s3_event_body(bucket, key, etag, size))
+
+    def __len__(self):
+        with self.condition:
+            return len(self.messages)
+
+    def _visible(self, now):
+        return [mid for mid, m in self.messages.items() if m["visible_at"] <= now]
+
+    def receive(self):
+        """Wait up to batch_window for a full batch; returns an SQS Lambda event (possibly empty)."""
+        deadline = time.monotonic() + self.batch_window
+        with self.condition:
+            while len(self._visible(time.monotonic())) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            now = time.monotonic()
+            records = []
+            for message_id in self._visible(now)[:self.batch_size]:
+                message = self.messages[message_id]
+                message["receive_count"] += 1
+                message["visible_at"] = now + self.visibility_timeout
+                records.append({
+                    "messageId": message_id,
+                    "receiptHandle": message_id,
+                    "body": message["body"],
+                    "attributes": {"ApproximateReceiveCount": str(message["receive_count"])},
+                    "eventSource": "aws:sqs",
+                    "eventSourceARN": "arn:aws:sqs:local:000000000000:memory-queue",
+                })
+            return {"Records": records}
+
+    def acknowledge(self, event, response):
+        """Delete the messages of a batch that did not fail; dead-letter exhausted failures."""
+        failed = {f["itemIdentifier"] for f in (response or {}).get("batchItemFailures", [])}
+        with self.condition:
+            for record in event["Records"]:
+                message_id = record["messageId"]
+                message = self.messages.get(message_id)
+                if message is None:
+                    continue
+                if message_id not in failed:
+                    del self.messages[message_id]
+                elif message["receive_count"] >= self.max_receive_count:
+                    self.dead_letters.append(self.messages.pop(message_id))
+            self.condition.notify_all()
+
+    def drain(self, handler, context=None):
+        """Feed batches to handler(event, context) until the queue is empty; returns the batch count."""
+        batches = 0
+        while len(self):
+            event = self.receive()
+            if not event["Records"]:
+                # Everything left is in flight until its visibility timeout expires
+                time.sleep(0.1)
+                continue
+            try:
+                response = handler(event, context)
+            except Exception as e:
+                # A raised error fails the whole batch, as with the real event source mapping
+                print(f"Batch failed: {e}")
+                response = {"batchItemFailures": [{"itemIdentifier": r["messageId"]} for r in event["Records"]]}
+            self.acknowledge(event, response)
+            batches += 1
+        return batches
@@ -1,17 +1,40 @@
 import json
 import os
+import hashlib
+from email.parser import BytesParser
+from email.policy import default
 import boto3
 import cv2
 import numpy as np
 from tempfile import NamedTemporaryFile
 from ultralytics import YOLO
 
+import detection_cache
+
 dynamodb = boto3.resource('dynamodb')
 table = dynamodb.Table('BirdnetTaggedFiles')
 
 model = YOLO("model.pt")
 class_dict = model.names
 
+# Detection cache entries are versioned by a hash of the baked-in weights unless MODEL_VERSION is set
+MODEL_VERSION = os.environ.get("MODEL_VERSION")
+
+def detection_version(file_type):
+    """Cache version of tags for this file type; tag_video sums detections over all frames."""
+    model_version = MODEL_VERSION or detection_cache.file_weights_version("model.pt")
+    return detection_cache.cache_version(model_version, "sum" if file_type == "video" else None)
+
+def uploaded_file(body, content_type):
+    """(filename, bytes) of the first file part of a multipart/form-data body."""
+    message = BytesParser(policy=default).parsebytes(
+        b"Content-Type: " + content_type.encode("utf-8") + b"\r\n\r\n" + body)
+    for part in message.iter_parts():
+        filename = part.get_filename()
+        if filename:
+            return filename, part.get_payload(decode=True)
+    return None, None
+
 def tag_image(img):
     result = model(img)[0]
     counts = {}
@@ -66,23 +89,35 @@ def lambda_handler(event, context):
         if event.get("isBase64Encoded"):
             import base64
             body = base64.b64decode(body)
-
-        with NamedTemporaryFile(delete=False, suffix=".tmp") as tmp_file:
-            tmp_file.write(body)
-            tmp_path = tmp_file.name
-
-        ext = get_file_type(tmp_path)
-        if ext == "image":
-            img = cv2.imread(tmp_path)
-            if img is None:
-                raise Exception("Could not read image")
-            tags = tag_image(img)
-        elif ext == "video":
-            tags = tag_video(tmp_path)
-        else:
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        # Hash only the file: the multipart boundary around it is random per request
+        filename, data = uploaded_file(body, content_type)
+        if not data:
+            return {'statusCode': 400, 'body': json.dumps({'error': 'No file in request'})}
+        ext = get_file_type(filename)
+        if ext == "unknown":
             return {'statusCode': 400, 'body': json.dumps({'error': 'Unsupported file type'})}
 
-        os.remove(tmp_path)
+        content_key = "sha256:" + hashlib.sha256(data).hexdigest()
+        tags = detection_cache.get_cached_tags(content_key, detection_version(ext))
+
+        if tags is None:
+            with NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[-1].lower()) as tmp_file:
+                tmp_file.write(data)
+                tmp_path = tmp_file.name
+
+            if ext == "image":
+                img = cv2.imread(tmp_path)
+                if img is None:
+                    raise Exception("Could not read image")
+                tags = tag_image(img)
+            else:
+                tags = tag_video(tmp_path)
+
+            os.remove(tmp_path)
+            detection_cache.put_cached_tags(content_key, tags, detection_version(ext))
 
         if not tags:
             return {'statusCode': 200, 'body': json.dumps({'tags': {}, 'links': []})}
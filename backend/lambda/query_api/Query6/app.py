@@ -6,6 +6,16 @@ dynamodb = boto3.resource('dynamodb')
 s3 = boto3.client('s3')
 table = dynamodb.Table('BirdnetTaggedFiles')
 
+# Every attribute that can point at an object stored for the file
+URL_FIELDS = ['original_url', 'thumbnail_url', 'preview_url', 'timeline_url', 'waveform_url', 'spectrogram_url']
+
+def stored_urls(item):
+    """S3 URLs of the original and everything derived from it, including the thumbnail ladder."""
+    urls = {item.get(field) for field in URL_FIELDS}
+    for formats in (item.get('thumbnails') or {}).values():
+        urls.update(formats.values())
+    return sorted(url for url in urls if url)
+
 def lambda_handler(event, context):
     try:
         if 'body' in event and isinstance(event['body'], str):
@@ -37,12 +47,9 @@ def lambda_handler(event, context):
             if not matched_item:
                 continue
 
-            # Delete original file from S3
-            delete_s3_object(matched_item['original_url'])
-
-            # Delete thumbnail if it's an image
-            if matched_item.get('file_type') == 'images' and matched_item.get('thumbnail_url'):
-                delete_s3_object(matched_item['thumbnail_url'])
+            # Delete the original, its thumbnails, previews and audio timeline from S3
+            for stored_url in stored_urls(matched_item):
+                delete_s3_object(stored_url)
 
             # Delete from DynamoDB
             table.delete_item(Key={'file_id': matched_item['file_id']})
@@ -1,31 +1,289 @@
 import boto3
+import hashlib
+import io
+import json
 import os
-import tempfile
-from PIL import Image
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
+from PIL import Image, ImageOps, features
 import PIL.Image
 
+# Clients, not resources: records are processed on worker threads and boto3 resources
+# are not thread-safe
 s3 = boto3.client('s3')
+dynamodb = boto3.client('dynamodb')
+TABLE_NAME = os.environ.get('METADATA_TABLE', 'BirdMediaMetadata')
+
+THUMBNAIL_SIZE = (128, 128)
+# Rendition ladder (longest edge in px) and formats; AVIF is skipped if this Pillow lacks it
+RENDITION_SIZES = [int(s) for s in os.environ.get('THUMBNAIL_SIZES', '64,128,256,512').split(',')]
+RENDITION_FORMATS = os.environ.get('THUMBNAIL_FORMATS', 'jpeg,webp,avif').split(',')
+# format -> (Pillow format, extension, content type, save options)
+FORMAT_OPTIONS = {
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg', {'quality': 85, 'optimize': True}),
+    'webp': ('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    'avif': ('AVIF', 'avif', 'image/avif', {'quality': 60}),
+}
+# The rendition used as the item's thumbnail_url
+DEFAULT_RENDITION = (128, 'jpeg')
+# Renditions live under their own prefix: thumbnail_tagging writes a differently encoded
+# ladder under thumbnails/, and sharing keys would make each pipeline overwrite the other
+RENDITION_PREFIX = os.environ.get('THUMBNAIL_PREFIX', 'thumbnails/pillow/')
+# The metadata item is written by the tagger; wait this long for it before failing the record
+RECORD_RETRY_DELAYS = [1, 2, 4]
+# Byte-budget encoding: "size:bytes,..." binary-searches the quality of each rendition to fit
+# its budget (sizes without a budget keep the fixed quality above). THUMBNAIL_SUBSAMPLING=auto
+# keeps full-resolution chroma (4:4:4) for JPEGs when the budget still allows SUBSAMPLING_444_MIN_QUALITY.
+BYTE_BUDGETS = {int(size): int(budget) for size, budget in
+                (part.split(':') for part in os.environ.get('THUMBNAIL_BYTE_BUDGETS', '').split(',') if part)}
+MIN_QUALITY = int(os.environ.get('THUMBNAIL_MIN_QUALITY', '40'))
+SUBSAMPLING = os.environ.get('THUMBNAIL_SUBSAMPLING', '4:2:0')
+SUBSAMPLING_444_MIN_QUALITY = 80
+# JPEG renditions at least this large are written progressive
+PROGRESSIVE_MIN_SIZE = int(os.environ.get('THUMBNAIL_PROGRESSIVE_MIN_SIZE', '256'))
+# Records are processed concurrently: S3 downloads/uploads overlap with Pillow work
+MAX_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', '4'))
+# LANCZOS after a DCT-domain draft downscale: sharp thumbnails at a fraction of a full decode
+RESAMPLE = Image.Resampling.LANCZOS
+
+def make_thumbnail(img, size=THUMBNAIL_SIZE):
+    """
+    Return an upright RGB thumbnail that fits in `size`.
+    For JPEGs, draft() makes the decoder scale down by 1/2, 1/4 or 1/8 while
+    decoding, so a 40 MP photo is never decoded at full resolution. The draft target
+    is twice the thumbnail size so the final resample still has detail to work with.
+    """
+    # draft() must run before anything loads pixel data (exif_transpose does)
+    # and has to cover either orientation, since the EXIF rotation is applied later.
+    draft_edge = 2 * max(size)
+    img.draft('RGB', (draft_edge, draft_edge))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.thumbnail(size, resample=RESAMPLE, reducing_gap=2.0)
+    return img
+
+def available_formats():
+    return [f for f in RENDITION_FORMATS if f != 'avif' or features.check('avif')]
+
+def make_renditions(img, sizes=RENDITION_SIZES):
+    """
+    Decode once (drafted for the largest size) and derive every size from it,
+    each smaller rendition resampled from the previous one. Returns {size: image}.
+    """
+    sizes = sorted(set(sizes), reverse=True)
+    current = make_thumbnail(img, (sizes[0], sizes[0]))
+    renditions = {}
+    for size in sizes:
+        current = current.copy()
+        current.thumbnail((size, size), resample=RESAMPLE)
+        renditions[size] = current
+    return renditions
+
+def fit_to_budget(encode, budget, low, high):
+    """
+    Binary-search the highest quality in [low, high] whose encoding fits in `budget` bytes.
+    encode(quality) returns bytes. Returns (quality, data), or None if even `low` is too big.
+    """
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(quality)
+        if len(data) <= budget:
+            best = (quality, data)
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+def encode_rendition(image, size, fmt):
+    """Encode one rendition, fitting it to its byte budget when one is configured."""
+    pil_format, _, _, options = FORMAT_OPTIONS[fmt]
+    options = dict(options)
+    if fmt == 'jpeg' and size >= PROGRESSIVE_MIN_SIZE:
+        options['progressive'] = True
+
+    def encode(**overrides):
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, **dict(options, **overrides))
+        return buffer.getvalue()
+
+    budget = BYTE_BUDGETS.get(size)
+    if not budget or 'quality' not in options:
+        return encode()
+
+    max_quality = options['quality']
+    overrides = {}
+    if fmt == 'jpeg' and SUBSAMPLING == 'auto':
+        fitted = fit_to_budget(lambda q: encode(quality=q, subsampling='4:4:4'), budget,
+                               SUBSAMPLING_444_MIN_QUALITY, max(max_quality, SUBSAMPLING_444_MIN_QUALITY))
+        if fitted:
+            return fitted[1]
+        overrides['subsampling'] = '4:2:0'
+    elif fmt == 'jpeg':
+        overrides['subsampling'] = SUBSAMPLING
+    fitted = fit_to_budget(lambda q: encode(quality=q, **overrides), budget, MIN_QUALITY, max_quality)
+    # Over budget even at the minimum quality: the smallest allowed encoding is the best we can do
+    return fitted[1] if fitted else encode(quality=MIN_QUALITY, **overrides)
+
+def rendition_key(key, size, fmt):
+    # The full file name, extension included, so bird.jpg and bird.png do not share renditions
+    return f"{RENDITION_PREFIX}{os.path.basename(key)}-{size}.{FORMAT_OPTIONS[fmt][1]}"
+
+def rendition_params():
+    """Short digest of everything that affects the rendition bytes; stored on each thumbnail."""
+    params = [sorted(set(RENDITION_SIZES)), available_formats(),
+              {fmt: FORMAT_OPTIONS[fmt][3] for fmt in available_formats()},
+              'pillow-draft', str(RESAMPLE), BYTE_BUDGETS, MIN_QUALITY, SUBSAMPLING, PROGRESSIVE_MIN_SIZE]
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def thumbnail_metadata(source_etag):
+    return {'source-etag': source_etag, 'rendition-params': rendition_params()}
+
+def marker_key(key):
+    """The rendition upload_renditions writes last; if it is current, so are the others."""
+    return rendition_key(key, min(RENDITION_SIZES), available_formats()[-1])
+
+def is_current(bucket, key, source_etag):
+    """Cheap HEAD check that the renditions of key were generated from this source with these parameters."""
+    try:
+        head = s3.head_object(Bucket=bucket, Key=marker_key(key))
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return head.get('Metadata', {}) == thumbnail_metadata(source_etag)
+
+def rendition_urls(bucket, key):
+    """The {size: {format: s3 url}} map upload_renditions would return, without uploading."""
+    return {str(size): {fmt: f"s3://{bucket}/{rendition_key(key, size, fmt)}" for fmt in available_formats()}
+            for size in sorted(set(RENDITION_SIZES), reverse=True)}
+
+def upload_renditions(bucket, key, renditions, source_etag):
+    """
+    Encode every size in every available format and upload it, largest first so the
+    marker rendition is written last. Returns {size: {format: s3 url}}.
+    """
+    metadata = thumbnail_metadata(source_etag)
+    urls = {}
+    for size in sorted(renditions, reverse=True):
+        for fmt in available_formats():
+            content_type = FORMAT_OPTIONS[fmt][2]
+            out_key = rendition_key(key, size, fmt)
+            s3.put_object(Bucket=bucket, Key=out_key, Body=encode_rendition(renditions[size], size, fmt),
+                          ContentType=content_type, Metadata=metadata)
+            urls.setdefault(str(size), {})[fmt] = f"s3://{bucket}/{out_key}"
+    return urls
+
+def record_renditions(key, urls):
+    """
+    Store the rendition keys on the media's metadata item. The update only applies to an
+    existing item: creating a sparse one would be overwritten by the tagger's put_item.
+    Raises if the item still does not exist after the retries, so the record is retried.
+    """
+    default_size, default_format = DEFAULT_RENDITION
+    values = {':r': {'M': {size: {'M': {fmt: {'S': url} for fmt, url in formats.items()}}
+                           for size, formats in urls.items()}}}
+    update = 'SET thumbnails = :r'
+    default_url = urls.get(str(default_size), {}).get(default_format)
+    if default_url:
+        update += ', thumbnail_url = :t'
+        values[':t'] = {'S': default_url}
+    for delay in RECORD_RETRY_DELAYS + [None]:
+        try:
+            dynamodb.update_item(TableName=TABLE_NAME, Key={'file_id': {'S': os.path.basename(key)}},
+                                 UpdateExpression=update, ExpressionAttributeValues=values,
+                                 ConditionExpression='attribute_exists(file_id)')
+            return
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException' or delay is None:
+                raise
+        print(f"No metadata item for {key} yet, retrying in {delay}s")
+        time.sleep(delay)
+
+def s3_records(body):
+    """
+    S3 event records in a notification body, unwrapping the SNS envelope when S3
+    notifies a topic that fans out to the queue. s3:TestEvent, sent when the
+    notification is configured, carries no records.
+    """
+    if 'Message' in body and 'Records' not in body:
+        body = json.loads(body['Message'])
+    return body.get('Records', [])
+
+def iter_s3_objects(event):
+    """
+    Yield (message_id, s3 record) for every object in an S3 event, an SNS event or
+    an SQS batch of either. message_id is None outside SQS.
+    """
+    for record in event.get('Records', []):
+        if record.get('eventSource') == 'aws:sqs':
+            inner = s3_records(json.loads(record['body']))
+            if not inner:
+                print(f"No S3 records in message {record['messageId']}, skipping")
+            for r in inner:
+                yield record['messageId'], r['s3']
+        elif record.get('EventSource') == 'aws:sns':
+            for r in s3_records(record['Sns']):
+                yield None, r['s3']
+        else:
+            yield None, record['s3']
+
+def process_object(bucket, key, etag=None):
+    """
+    Create, upload and record every rendition of one image, entirely in memory.
+    Re-delivered events for an unchanged source only cost a HEAD request.
+    """
+    if etag and is_current(bucket, key, etag):
+        print(f"Thumbnails already current for {key}")
+        urls = rendition_urls(bucket, key)
+        record_renditions(key, urls)
+        return urls
+
+    response = s3.get_object(Bucket=bucket, Key=key)
+    # The ETag of the bytes actually decoded, in case the object changed since the event
+    etag = response['ETag'].strip('"')
+    body = response['Body'].read()
+    # Create every thumbnail rendition from a single decode using Pillow
+    with Image.open(io.BytesIO(body)) as img:
+        renditions = make_renditions(img)  # Resize maintaining aspect ratio
+    # Upload renditions back to S3 and record them on the metadata item
+    urls = upload_renditions(bucket, key, renditions, etag)
+    record_renditions(key, urls)
+    return urls
+
+def process_record(item):
+    message_id, record = item
+    bucket = record['bucket']['name']
+    key = unquote_plus(record['object']['key'])
+    try:
+        urls = process_object(bucket, key, record['object'].get('eTag', '').strip('"'))
+        return {'messageId': message_id, 'key': key, 'status': 'ok', 'thumbnails': urls}
+    except Exception as e:
+        print(f"Thumbnail generation failed for s3://{bucket}/{key}: {e}")
+        return {'messageId': message_id, 'key': key, 'status': 'error', 'error': str(e)}
 
 def lambda_handler(event, context):
-    # Get bucket name and object key
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
-    
-    # Download file from S3
-    download_path = os.path.join(tempfile.gettempdir(), os.path.basename(key))
-    s3.download_file(bucket, key, download_path)
-    
-    # Create thumbnail using Pillow
-    thumbnail_path = os.path.join(tempfile.gettempdir(), f"thumb-{os.path.basename(key)}")
-    with Image.open(download_path) as img:
-        img.thumbnail((128, 128))  # Resize maintaining aspect ratio
-        img.save(thumbnail_path, format="JPEG", quality=85)
-    
-    # Upload thumbnail back to S3
-    thumbnail_key = f"thumbnails/thumb-{os.path.basename(key)}"
-    s3.upload_file(thumbnail_path, bucket, thumbnail_key)
-    
-    return {
-        'statusCode': 200,
-        'body': f'Thumbnail created: {thumbnail_key}'
-    }
\ No newline at end of file
+    items = list(iter_s3_objects(event))
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(items)))) as pool:
+        results = list(pool.map(process_record, items))
+
+    failed = [r for r in results if r['status'] != 'ok']
+    print(f"Thumbnails created for {len(results) - len(failed)}/{len(results)} objects")
+
+    response = {
+        'statusCode': 200 if not failed else 207,
+        'body': json.dumps(results),
+    }
+    # SQS partial batch response: only the failed messages are retried
+    failed_ids = sorted({r['messageId'] for r in failed if r['messageId']})
+    if failed_ids:
+        response['batchItemFailures'] = [{'itemIdentifier': m} for m in failed_ids]
+    elif failed:
+        # Direct S3 invocations have no partial retry, fail so the event is retried
+        raise RuntimeError(f"Thumbnail generation failed for {len(failed)} object(s)")
+    else:
+        response['batchItemFailures'] = []
+    return response
@@ -5,6 +5,16 @@ s3 = boto3.client("s3")
 dynamodb = boto3.resource("dynamodb")
 table = dynamodb.Table("BirdMediaMetadata")
 
+# Every attribute that can point at an object stored for the file
+URL_FIELDS = ["original_url", "thumbnail_url", "preview_url", "timeline_url", "waveform_url", "spectrogram_url"]
+
+def stored_urls(item):
+    """S3 URLs of the original and everything derived from it, including the thumbnail ladder."""
+    urls = {item.get(field) for field in URL_FIELDS}
+    for formats in (item.get("thumbnails") or {}).values():
+        urls.update(formats.values())
+    return sorted(url for url in urls if url)
+
 def lambda_handler(event, context):
     try:
         body = json.loads(event["body"])
@@ -25,9 +35,9 @@ def lambda_handler(event, context):
             if not item:
                 continue
 
-            # Delete original and thumbnail URLs from S3
-            for s3_url in [item.get("original_url"), item.get("thumbnail_url")]:
-                if s3_url and s3_url.startswith("s3://"):
+            # Delete the original, its thumbnails and previews from S3
+            for s3_url in stored_urls(item):
+                if s3_url.startswith("s3://"):
                     parts = s3_url.replace("s3://", "").split("/", 1)
                     if len(parts) == 2:
                         bucket, key = parts
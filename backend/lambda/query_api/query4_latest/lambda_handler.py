@@ -3,10 +3,15 @@ import os
 import boto3
 import cv2
 from ultralytics import YOLO
-from collections import Counter
-import subprocess
 import zipfile
 import time
+import hashlib
+import shutil
+import tempfile
+
+import birdnet_runner
+import detection_cache
+import sqs_ingest
 
 # AWS resources
 s3 = boto3.client('s3')
@@ -22,6 +27,14 @@ MODEL_LOCAL_PATH = "/tmp/model.pt"
 BIRDNET_BUCKET = "birdtag-storage-aus-dev"
 BIRDNET_ZIP_KEY = "models/audio/birdnet_analyzer.zip"
 BIRDNET_LOCAL_DIR = "/tmp/birdnet"
+BIRDNET_BAKED_DIR = os.environ.get("BIRDNET_BAKED_DIR", "/opt/birdnet")
+BIRDNET_MARKER = ".birdnet_checksum"
+BIRDNET_ZIP_SHA256 = os.environ.get("BIRDNET_ZIP_SHA256")
+
+# Detection cache entries are versioned by the weights (S3 ETag or baked-in checksum)
+# unless these are set
+YOLO_MODEL_VERSION = os.environ.get("YOLO_MODEL_VERSION")
+BIRDNET_MODEL_VERSION = os.environ.get("BIRDNET_MODEL_VERSION")
 
 # Model cache
 model = None
@@ -38,6 +51,28 @@ def load_model():
         class_dict.update(model.names)
         print("YOLO model loaded.")
 
+def s3_content_key(bucket, key, record=None):
+    obj = (record or {}).get('s3', {}).get('object', {})
+    etag, size = obj.get('eTag'), obj.get('size')
+    if not etag or size is None:
+        head = s3.head_object(Bucket=bucket, Key=key)
+        etag, size = head['ETag'], head['ContentLength']
+    return "etag:{}:{}".format(etag.strip('"'), size)
+
+def detection_version(file_type):
+    """Cache version of tags for this file type; tag_video sums detections over all frames."""
+    if file_type == "audio":
+        return BIRDNET_MODEL_VERSION or birdnet_version()
+    model_version = YOLO_MODEL_VERSION or detection_cache.s3_weights_version(MODEL_BUCKET, MODEL_KEY)
+    return detection_cache.cache_version(model_version, "sum" if file_type == "video" else None)
+
+def birdnet_version():
+    baked_marker = os.path.join(BIRDNET_BAKED_DIR, BIRDNET_MARKER)
+    if os.path.exists(baked_marker):
+        with open(baked_marker) as f:
+            return "sha256:" + f.read().strip()
+    return detection_cache.s3_weights_version(BIRDNET_BUCKET, BIRDNET_ZIP_KEY)
+
 def get_file_extension(filename):
     return os.path.splitext(filename)[-1].lower()
 
@@ -49,35 +84,46 @@ def convert_to_https(s3_uri):
     region = "us-east-1"
     return f"https://{bucket}.s3.{region}.amazonaws.com/{key}"
 
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 def prepare_birdnet_dir():
-    if not os.path.exists(BIRDNET_LOCAL_DIR):
-        print("Downloading and extracting BirdNET-Analyzer...")
-        s3.download_file(BIRDNET_BUCKET, BIRDNET_ZIP_KEY, '/tmp/birdnet_analyzer.zip')
-        with zipfile.ZipFile('/tmp/birdnet_analyzer.zip', 'r') as zip_ref:
-            zip_ref.extractall(BIRDNET_LOCAL_DIR)
-
-def analyze_audio(input_wav_path, output_dir, birdnet_dir):
-    cmd = [
-        "python3", "-m", "birdnet_analyzer.analyze",
-        os.path.dirname(input_wav_path), "-o", output_dir
-    ]
-    result = subprocess.run(cmd, capture_output=True, text=True, cwd=birdnet_dir)
-    print(result.stdout)
-    print(result.stderr)
-    species_counter = Counter()
-    for fname in os.listdir(output_dir):
-        if fname.endswith(".txt"):
-            with open(os.path.join(output_dir, fname)) as f:
-                for line in f:
-                    if line.startswith("#") or not line.strip():
-                        continue
-                    parts = line.strip().split('\t')
-                    if len(parts) > 7:
-                        species_name = parts[7]
-                        if species_name.strip().lower() == "common name":
-                            continue
-                        species_counter[species_name] += 1
-    return dict(species_counter)
+    """Return the baked-in BirdNET directory, or extract the S3 zip atomically into /tmp."""
+    if os.path.exists(os.path.join(BIRDNET_BAKED_DIR, BIRDNET_MARKER)):
+        return BIRDNET_BAKED_DIR
+    if os.path.exists(os.path.join(BIRDNET_LOCAL_DIR, BIRDNET_MARKER)):
+        return BIRDNET_LOCAL_DIR
+
+    print("Downloading and extracting BirdNET-Analyzer...")
+    zip_path = '/tmp/birdnet_analyzer.zip'
+    s3.download_file(BIRDNET_BUCKET, BIRDNET_ZIP_KEY, zip_path)
+    checksum = sha256_file(zip_path)
+    if BIRDNET_ZIP_SHA256 and checksum != BIRDNET_ZIP_SHA256:
+        os.remove(zip_path)
+        raise ValueError(f"Checksum mismatch for BirdNET zip: {checksum}")
+    staging_dir = tempfile.mkdtemp(prefix=".birdnet-", dir="/tmp")
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+            zip_ref.extractall(staging_dir)
+        with open(os.path.join(staging_dir, BIRDNET_MARKER), 'w') as f:
+            f.write(checksum)
+        if os.path.exists(BIRDNET_LOCAL_DIR):
+            shutil.rmtree(BIRDNET_LOCAL_DIR)
+        os.rename(staging_dir, BIRDNET_LOCAL_DIR)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    finally:
+        os.remove(zip_path)
+    return BIRDNET_LOCAL_DIR
+
+def analyze_audio(input_path, birdnet_dir):
+    runner = birdnet_runner.get_runner(birdnet_dir)
+    return birdnet_runner.count_species(runner.analyze_file(input_path))
 
 def tag_image(img):
     result = model(img)[0]
@@ -103,32 +149,36 @@ def tag_video(path):
     cap.release()
     return species_tracker
 
-def lambda_handler(event, context):
-    global model, class_dict
-    try:
-        # Get file info from S3 event
-        record = event["Records"][0]
-        file_bucket = record["s3"]["bucket"]["name"]
-        file_key = record["s3"]["object"]["key"]
-
-        print(f"Received S3 event for: s3://{file_bucket}/{file_key}")
-
-        # Get file extension and type
-        filename = os.path.basename(file_key)
-        ext = get_file_extension(filename)
-        file_type = (
-            'image' if ext in ['.jpg', '.jpeg', '.png']
-            else 'video' if ext in ['.mp4', '.avi', '.mov']
-            else 'audio' if ext in ['.wav', '.flac', '.mp3']
-            else None
-        )
-        if file_type is None:
-            print(f"Unsupported file type: {ext}")
-            return {
-                'statusCode': 400,
-                'body': json.dumps({'error': 'Unsupported file type'})
-            }
+def run_query(record):
+    """Tag one uploaded query file, look up matching media and store the result for the frontend."""
+    file_bucket = record["s3"]["bucket"]["name"]
+    file_key = record["s3"]["object"]["key"]
 
+    print(f"Received S3 event for: s3://{file_bucket}/{file_key}")
+
+    # Get file extension and type
+    filename = os.path.basename(file_key)
+    ext = get_file_extension(filename)
+    file_type = (
+        'image' if ext in ['.jpg', '.jpeg', '.png']
+        else 'video' if ext in ['.mp4', '.avi', '.mov']
+        else 'audio' if ext in ['.wav', '.flac', '.mp3']
+        else None
+    )
+    if file_type is None:
+        print(f"Unsupported file type: {ext}")
+        return {
+            'statusCode': 400,
+            'body': json.dumps({'error': 'Unsupported file type'})
+        }
+
+    version = detection_version(file_type)
+    content_key = s3_content_key(file_bucket, file_key, record)
+    tags = detection_cache.get_cached_tags(content_key, version)
+
+    if tags is not None:
+        print(f"Detection cache hit for {file_key}")
+    else:
         # Download file to /tmp
         tmp_path = f"/tmp/{filename}"
         s3.download_file(file_bucket, file_key, tmp_path)
@@ -147,59 +197,65 @@ def lambda_handler(event, context):
         elif file_type == "video":
             tags = tag_video(tmp_path)
         elif file_type == "audio":
-            prepare_birdnet_dir()
-            output_dir = "/tmp/audio_output"
-            os.makedirs(output_dir, exist_ok=True)
-            tags = analyze_audio(tmp_path, output_dir, BIRDNET_LOCAL_DIR)
+            tags = analyze_audio(tmp_path, prepare_birdnet_dir())
 
         os.remove(tmp_path)
-        print("Detected tags:", tags)
-
-        if not tags:
-            return {
-                'statusCode': 200,
-                'body': json.dumps({'tags': {}, 'links': []}),
-                'headers': {
-                    'Content-Type': 'application/json',
-                    'Access-Control-Allow-Origin': '*'
-                }
-            }
-
-        # Lookup in DynamoDB
-        detected_species = set(tags.keys())
-        response = table.scan()
-        matched_links = []
-        for item in response.get('Items', []):
-            item_tags = item.get('tags', {})
-            if any(tag in item_tags for tag in detected_species):
-                if item.get('file_type') == 'image' and item.get('thumbnail_url'):
-                    matched_links.append(convert_to_https(item['thumbnail_url']))
-                elif item.get('original_url'):
-                    matched_links.append(convert_to_https(item['original_url']))
-
-        print("Matched links:", matched_links)
-
-        # Delete the uploaded file from S3
-        s3.delete_object(Bucket=file_bucket, Key=file_key)
-        print(f"Deleted original file s3://{file_bucket}/{file_key} from S3.")
-
-        results_table = dynamodb.Table("TempQueryResults")
-        results_table.put_item(Item={
-            'file_key': file_key,
-            'tags': tags,
-            'links': matched_links,
-            'ttl': int(time.time()) + 300  # optional: expire in 30 minutes
-        })
+        detection_cache.put_cached_tags(content_key, tags, version)
+    print("Detected tags:", tags)
 
+    if not tags:
         return {
             'statusCode': 200,
-            'body': json.dumps({'tags': tags, 'links': matched_links}),
+            'body': json.dumps({'tags': {}, 'links': []}),
             'headers': {
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             }
         }
 
+    # Lookup in DynamoDB
+    detected_species = set(tags.keys())
+    response = table.scan()
+    matched_links = []
+    for item in response.get('Items', []):
+        item_tags = item.get('tags', {})
+        if any(tag in item_tags for tag in detected_species):
+            if item.get('file_type') == 'image' and item.get('thumbnail_url'):
+                matched_links.append(convert_to_https(item['thumbnail_url']))
+            elif item.get('original_url'):
+                matched_links.append(convert_to_https(item['original_url']))
+
+    print("Matched links:", matched_links)
+
+    # Delete the uploaded file from S3
+    s3.delete_object(Bucket=file_bucket, Key=file_key)
+    print(f"Deleted original file s3://{file_bucket}/{file_key} from S3.")
+
+    results_table = dynamodb.Table("TempQueryResults")
+    results_table.put_item(Item={
+        'file_key': file_key,
+        'tags': tags,
+        'links': matched_links,
+        'ttl': int(time.time()) + 300  # optional: expire in 30 minutes
+    })
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({'tags': tags, 'links': matched_links}),
+        'headers': {
+            'Content-Type': 'application/json',
+            'Access-Control-Allow-Origin': '*'
+        }
+    }
+
+def lambda_handler(event, context):
+    # Query uploads buffered through SQS: one warm model for the whole batch, failed messages retried alone
+    if sqs_ingest.is_sqs_event(event):
+        return sqs_ingest.process_sqs_event(event, run_query)
+
+    try:
+        # Get file info from S3 event
+        return run_query(event["Records"][0])
     except Exception as e:
         print("Unhandled exception:", str(e))
         return {
@@ -1,11 +1,22 @@
+import hashlib
+import io
 import json
 import os
+import multiprocessing
+import numbers
 import boto3
 import cv2
 import numpy as np
 from urllib.parse import unquote_plus
+from botocore.exceptions import ClientError
+from PIL import Image
 from ultralytics import YOLO
 
+import detection_cache
+import fanout
+import ingest
+import sqs_ingest
+
 # AWS clients
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
@@ -15,6 +26,62 @@ table = dynamodb.Table('BirdnetTaggedFiles')
 MODEL_BUCKET = "birdfile-models"
 MODEL_KEY = "models/yolo/model.pt"
 MODEL_LOCAL_PATH = "/tmp/model.pt"
+# Detection cache entries are versioned by the weights' ETag unless MODEL_VERSION is set
+MODEL_VERSION = os.environ.get("MODEL_VERSION")
+
+# Thumbnail rendition ladder (longest edge in px) and formats; AVIF only if OpenCV can write it
+RENDITION_SIZES = [int(s) for s in os.environ.get("THUMBNAIL_SIZES", "64,128,256,512").split(",")]
+RENDITION_FORMATS = os.environ.get("THUMBNAIL_FORMATS", "jpeg,webp,avif").split(",")
+# format -> (extension, content type, imencode params)
+FORMAT_OPTIONS = {
+    "jpeg": (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 85]),
+    "webp": (".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    "avif": (".avif", "image/avif", []),
+}
+# The rendition used as the item's thumbnail_url
+DEFAULT_RENDITION = (128, "jpeg")
+# Byte-budget encoding: "size:bytes,..." binary-searches the quality of each rendition to fit
+# its budget (sizes without a budget keep the fixed quality above). THUMBNAIL_SUBSAMPLING=auto
+# keeps full-resolution chroma (4:4:4) for JPEGs when the budget still allows SUBSAMPLING_444_MIN_QUALITY.
+BYTE_BUDGETS = {int(size): int(budget) for size, budget in
+                (part.split(":") for part in os.environ.get("THUMBNAIL_BYTE_BUDGETS", "").split(",") if part)}
+MIN_QUALITY = int(os.environ.get("THUMBNAIL_MIN_QUALITY", "40"))
+SUBSAMPLING = os.environ.get("THUMBNAIL_SUBSAMPLING", "4:2:0")
+SUBSAMPLING_444_MIN_QUALITY = 80
+# imencode quality flag per format (AVIF quality needs OpenCV >= 4.10) and JPEG sampling factors (>= 4.5.5)
+QUALITY_FLAGS = {
+    "jpeg": cv2.IMWRITE_JPEG_QUALITY,
+    "webp": cv2.IMWRITE_WEBP_QUALITY,
+    "avif": getattr(cv2, "IMWRITE_AVIF_QUALITY", None),
+}
+SAMPLING_FACTORS = {
+    "4:4:4": getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR_444", None),
+    "4:2:0": getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR_420", None),
+}
+# JPEG renditions at least this large are written progressive
+PROGRESSIVE_MIN_SIZE = int(os.environ.get("THUMBNAIL_PROGRESSIVE_MIN_SIZE", "256"))
+
+# Video previews: frames are sampled by seeking, the poster is the sampled frame with the
+# most confident detection (middle frame without detections)
+POSTER_CANDIDATES = int(os.environ.get("POSTER_CANDIDATES", "5"))
+PREVIEW_FRAMES = int(os.environ.get("PREVIEW_FRAMES", "12"))
+PREVIEW_SIZE = int(os.environ.get("PREVIEW_SIZE", "240"))
+PREVIEW_FPS = 4
+
+# Video tagging: every extra worker is a process with its own copy of the model, so
+# parallel tagging is opt-in; size the function's memory for VIDEO_WORKERS models
+# before raising it (0 = one per vCPU). Aggregation is "max", "sum" or "tracks"
+VIDEO_WORKERS = int(os.environ.get("VIDEO_WORKERS", "1"))
+VIDEO_AGGREGATION = os.environ.get("VIDEO_AGGREGATION", "max")
+MIN_FRAMES_PER_WORKER = 150
+
+# Videos longer than FANOUT_MIN_SECONDS are split across invocations (0 disables)
+FANOUT_MIN_SECONDS = float(os.environ.get("FANOUT_MIN_SECONDS", "600"))
+FANOUT_SEGMENT_SECONDS = float(os.environ.get("FANOUT_SEGMENT_SECONDS", "120"))
+FANOUT_EXECUTOR = os.environ.get("FANOUT_EXECUTOR", "lambda")  # "lambda" or "local"
+FANOUT_FUNCTION_NAME = os.environ.get("FANOUT_FUNCTION_NAME")
+FANOUT_PARTIAL_TABLE = os.environ.get("FANOUT_PARTIAL_TABLE", "BirdnetSegmentResults")
+FANOUT_URL_EXPIRY = 3600
 
 # Model will be loaded on cold start
 model = None
@@ -29,13 +96,235 @@ def load_model():
         model = YOLO(MODEL_LOCAL_PATH)
         class_dict = model.names
 
-def resize_image(image, width=128):
+def s3_object_identity(bucket, key, record=None):
+    """(ETag, size) of an object, taken from the S3 event when present."""
+    obj = (record or {}).get('s3', {}).get('object', {})
+    etag, size = obj.get('eTag'), obj.get('size')
+    if not etag or size is None:
+        head = s3.head_object(Bucket=bucket, Key=key)
+        etag, size = head['ETag'], head['ContentLength']
+    return etag.strip('"'), size
+
+def s3_content_key(etag, size):
+    """Identify object content by ETag plus size."""
+    return "etag:{}:{}".format(etag, size)
+
+def detection_version(file_type, aggregation=VIDEO_AGGREGATION):
+    """Cache version of tags for this file type: the YOLO weights, plus the aggregation for videos."""
+    model_version = MODEL_VERSION or detection_cache.s3_weights_version(MODEL_BUCKET, MODEL_KEY)
+    return detection_cache.cache_version(model_version, aggregation if file_type == "videos" else None)
+
+def resize_image(image, size=128):
+    """Fit the image inside a size x size box, never upscaling."""
     h, w = image.shape[:2]
-    new_h = int((width / w) * h)
-    return cv2.resize(image, (width, new_h))
+    scale = min(1.0, size / max(h, w))
+    if scale == 1.0:
+        return image
+    return cv2.resize(image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+def default_thumbnail_url(thumbnails):
+    default_size, default_format = DEFAULT_RENDITION
+    return thumbnails.get(str(default_size), {}).get(default_format)
+
+def presigned_get_url(bucket, key, expires=3600):
+    return s3.generate_presigned_url('get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=expires)
+
+def sample_video_frames(source, count):
+    """
+    Grab `count` frames at evenly spaced timestamps. Each one is a seek, so only
+    the data around those positions is fetched and decoded, not the whole stream.
+    """
+    cap = cv2.VideoCapture(source)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for i in range(count if frame_count > 0 else 0):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int((i + 0.5) * frame_count / count))
+        ret, frame = cap.read()
+        if ret:
+            frames.append(frame)
+    cap.release()
+    return frames
+
+def pick_poster(frames, detect):
+    """Index of the poster frame: highest detection confidence among a few candidates, else the middle."""
+    middle = len(frames) // 2
+    if not detect:
+        return middle
+    load_model()
+    step = max(1, len(frames) // POSTER_CANDIDATES)
+    best_index, best_conf = middle, 0.0
+    for i in range(0, len(frames), step):
+        confs = model(frames[i], verbose=False)[0].boxes.conf.cpu().numpy()
+        if len(confs) and confs.max() > best_conf:
+            best_index, best_conf = i, float(confs.max())
+    return best_index
+
+def make_video_previews(bucket, key, source, source_etag, detect=True):
+    """
+    Upload a poster rendition ladder and a short low-res animated WebP preview for a
+    video; unlike MPEG-4 Part 2 from cv2.VideoWriter, browsers play it in an <img>.
+    Returns write_metadata keyword arguments (thumbnail_url, thumbnails, preview_url).
+    Nothing is decoded when the preview (uploaded last) is already current.
+    """
+    preview_key = f"thumbnails/{os.path.basename(key)}-preview.webp"
+    if is_current(bucket, preview_key, source_etag):
+        print(f"Video previews already current for {key}")
+        thumbnails = rendition_urls(bucket, key)
+        return {
+            "thumbnail_url": default_thumbnail_url(thumbnails),
+            "thumbnails": thumbnails,
+            "preview_url": f"s3://{bucket}/{preview_key}",
+        }
+
+    frames = sample_video_frames(source, max(PREVIEW_FRAMES, POSTER_CANDIDATES))
+    if not frames:
+        print(f"Could not sample frames for previews: {key}")
+        return {}
+
+    poster = frames[pick_poster(frames, detect)]
+    thumbnails = upload_renditions(bucket, key, make_renditions(poster), source_etag)
+
+    preview_frames = [Image.fromarray(cv2.cvtColor(resize_image(frame, PREVIEW_SIZE), cv2.COLOR_BGR2RGB))
+                      for frame in frames]
+    buffer = io.BytesIO()
+    preview_frames[0].save(buffer, format="WEBP", save_all=True, append_images=preview_frames[1:],
+                           duration=int(1000 / PREVIEW_FPS), loop=0, quality=70)
+    s3.put_object(Bucket=bucket, Key=preview_key, Body=buffer.getvalue(), ContentType="image/webp",
+                  Metadata=thumbnail_metadata(source_etag))
+
+    return {
+        "thumbnail_url": default_thumbnail_url(thumbnails),
+        "thumbnails": thumbnails,
+        "preview_url": f"s3://{bucket}/{preview_key}",
+    }
+
+def rendition_params():
+    """Short digest of everything that affects the rendition bytes; stored on each thumbnail."""
+    params = [sorted(set(RENDITION_SIZES)), available_formats(),
+              {fmt: FORMAT_OPTIONS[fmt][2] for fmt in available_formats()},
+              "cv2-area", "webp-preview", PREVIEW_FRAMES, PREVIEW_SIZE, PREVIEW_FPS,
+              BYTE_BUDGETS, MIN_QUALITY, SUBSAMPLING, PROGRESSIVE_MIN_SIZE]
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def thumbnail_metadata(source_etag):
+    return {"source-etag": source_etag, "rendition-params": rendition_params()}
+
+def rendition_key(key, size, fmt):
+    # The full file name, extension included, so bird.jpg and bird.mp4 do not share renditions
+    return f"thumbnails/{os.path.basename(key)}-{size}{FORMAT_OPTIONS[fmt][0]}"
+
+def marker_key(key):
+    """The rendition upload_renditions writes last; if it is current, so are the others."""
+    return rendition_key(key, min(RENDITION_SIZES), available_formats()[-1])
+
+def is_current(bucket, out_key, source_etag):
+    """Cheap HEAD check that out_key was generated from this source with these parameters."""
+    try:
+        head = s3.head_object(Bucket=bucket, Key=out_key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return head.get("Metadata", {}) == thumbnail_metadata(source_etag)
+
+def rendition_urls(bucket, key):
+    """The {size: {format: s3 url}} map upload_renditions would return, without uploading."""
+    return {str(size): {fmt: f"s3://{bucket}/{rendition_key(key, size, fmt)}" for fmt in available_formats()}
+            for size in sorted(set(RENDITION_SIZES), reverse=True)}
+
+def available_formats():
+    formats = []
+    for fmt in RENDITION_FORMATS:
+        ext = FORMAT_OPTIONS[fmt][0]
+        if fmt == 'avif' and not (hasattr(cv2, 'haveImageWriter') and cv2.haveImageWriter(ext)):
+            continue
+        formats.append(fmt)
+    return formats
+
+def make_renditions(image, sizes=RENDITION_SIZES):
+    """Derive every size from the decoded image, each one downscaled from the previous (larger) one."""
+    renditions = {}
+    current = image
+    for size in sorted(set(sizes), reverse=True):
+        current = resize_image(current, size)
+        renditions[size] = current
+    return renditions
+
+def fit_to_budget(encode, budget, low, high):
+    """
+    Binary-search the highest quality in [low, high] whose encoding fits in `budget` bytes.
+    encode(quality) returns bytes or None. Returns (quality, data), or None if even `low` is too big.
+    """
+    best = None
+    while low <= high:
+        quality = (low + high) // 2
+        data = encode(quality)
+        if data is not None and len(data) <= budget:
+            best = (quality, data)
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+def encode_rendition(image, size, fmt):
+    """Encode one rendition, fitting it to its byte budget when one is configured. None on failure."""
+    ext, _, params = FORMAT_OPTIONS[fmt]
+    params = list(params)
+    if fmt == "jpeg" and size >= PROGRESSIVE_MIN_SIZE:
+        params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+
+    def encode(quality=None, subsampling=None):
+        extra = []
+        if quality is not None:
+            extra += [QUALITY_FLAGS[fmt], quality]
+        if subsampling is not None and SAMPLING_FACTORS.get(subsampling) is not None:
+            extra += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, SAMPLING_FACTORS[subsampling]]
+        # Later flags override earlier ones in imencode's params list
+        ok, encoded = cv2.imencode(ext, image, params + extra)
+        return encoded.tobytes() if ok else None
+
+    budget = BYTE_BUDGETS.get(size)
+    if not budget or QUALITY_FLAGS.get(fmt) is None:
+        return encode()
+
+    flag = QUALITY_FLAGS[fmt]
+    max_quality = params[params.index(flag) + 1] if flag in params[::2] else 95
+    subsampling = None
+    if fmt == "jpeg" and SUBSAMPLING == "auto":
+        fitted = fit_to_budget(lambda q: encode(q, "4:4:4"), budget,
+                               SUBSAMPLING_444_MIN_QUALITY, max(max_quality, SUBSAMPLING_444_MIN_QUALITY))
+        if fitted:
+            return fitted[1]
+        subsampling = "4:2:0"
+    elif fmt == "jpeg":
+        subsampling = SUBSAMPLING
+    fitted = fit_to_budget(lambda q: encode(q, subsampling), budget, MIN_QUALITY, max_quality)
+    # Over budget even at the minimum quality: the smallest allowed encoding is the best we can do
+    return fitted[1] if fitted else encode(MIN_QUALITY, subsampling)
+
+def upload_renditions(bucket, key, renditions, source_etag):
+    """
+    Encode every size in every available format and upload it, largest first so the
+    marker rendition is written last. Returns {size: {format: s3 url}}.
+    """
+    metadata = thumbnail_metadata(source_etag)
+    urls = {}
+    for size in sorted(renditions, reverse=True):
+        for fmt in available_formats():
+            data = encode_rendition(renditions[size], size, fmt)
+            if data is None:
+                print(f"Failed to encode {fmt} rendition {size} for {key}")
+                continue
+            out_key = rendition_key(key, size, fmt)
+            s3.put_object(Bucket=bucket, Key=out_key, Body=data, ContentType=FORMAT_OPTIONS[fmt][1],
+                          Metadata=metadata)
+            urls.setdefault(str(size), {})[fmt] = f"s3://{bucket}/{out_key}"
+    return urls
 
 def tag_image(img):
-    result = model(img)[0]
+    return count_detections(model(img)[0])
+
+def count_detections(result):
     counts = {}
     for cls_id, conf in zip(result.boxes.cls.cpu().numpy(), result.boxes.conf.cpu().numpy()):
         if conf > 0.5:
@@ -43,82 +332,344 @@ def tag_image(img):
             counts[species] = counts.get(species, 0) + 1
     return counts
 
-def tag_video(video_path):
+def probe_video(video_path):
+    """Return (frame_count, fps) from the container header without decoding frames."""
+    cap = cv2.VideoCapture(video_path)
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    return max(frame_count, 0), fps
+
+def split_frame_ranges(frame_count, parts):
+    """Split [0, frame_count) into at most `parts` contiguous (start, end) ranges."""
+    parts = max(1, min(parts, frame_count))
+    step, extra = divmod(frame_count, parts)
+    ranges = []
+    start = 0
+    for i in range(parts):
+        end = start + step + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+def tag_video_range(video_path, start=0, end=None, aggregation="max"):
+    """
+    Tag frames [start, end) of a video. `end=None` reads to the end of the stream.
+
+    aggregation:
+        "max"    - highest per-frame count seen for each species
+        "sum"    - total detections over all frames
+        "tracks" - number of distinct tracker ids per species
+    """
+    if aggregation == "tracks":
+        reset_trackers()
     cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        # e.g. an expired pre-signed URL; raising fails the invocation so it is retried
+        # instead of being recorded as a range without detections
+        raise RuntimeError(f"Could not open video for frames {start}-{end}")
+    if start:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
     species_tracker = {}
+    track_ids = {}
+    position = start
 
-    while cap.isOpened():
+    while end is None or position < end:
         ret, frame = cap.read()
         if not ret:
             break
+        position += 1
 
-        result = model(frame)[0]
-        frame_counts = {}
-        for cls_id, conf in zip(result.boxes.cls.cpu().numpy(), result.boxes.conf.cpu().numpy()):
-            if conf > 0.5:
-                species = class_dict[int(cls_id)].lower()
-                frame_counts[species] = frame_counts.get(species, 0) + 1
+        if aggregation == "tracks":
+            result = model.track(frame, persist=True, verbose=False)[0]
+            if result.boxes.id is None:
+                continue
+            for cls_id, conf, trk_id in zip(result.boxes.cls.cpu().numpy(),
+                                            result.boxes.conf.cpu().numpy(),
+                                            result.boxes.id.cpu().numpy()):
+                if conf > 0.5:
+                    species = class_dict[int(cls_id)].lower()
+                    track_ids.setdefault(species, set()).add(int(trk_id))
+            continue
 
+        frame_counts = count_detections(model(frame, verbose=False)[0])
         for species, count in frame_counts.items():
-            if species not in species_tracker or count > species_tracker[species]:
+            if aggregation == "sum":
+                species_tracker[species] = species_tracker.get(species, 0) + count
+            elif species not in species_tracker or count > species_tracker[species]:
                 species_tracker[species] = count
 
     cap.release()
+    if end is not None and position < end:
+        raise RuntimeError(f"Video ended after frame {position}, expected frames {start}-{end}")
+    if aggregation == "tracks":
+        return {species: len(ids) for species, ids in track_ids.items()}
     return species_tracker
 
-def lambda_handler(event, context):
-    load_model()
+def reset_trackers():
+    # model.track(persist=True) keeps tracker state on the predictor between calls
+    predictor = getattr(model, "predictor", None)
+    for tracker in getattr(predictor, "trackers", None) or []:
+        tracker.reset()
 
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = unquote_plus(record['s3']['object']['key'])
-        base_name = os.path.basename(key)
-        file_type = key.split('/')[0].lower()
+def merge_range_results(results, aggregation="max"):
+    """Combine per-range tag dicts. Track ids are local to a range, so tracks are summed."""
+    merged = {}
+    for counts in results:
+        for species, count in counts.items():
+            if aggregation == "max":
+                merged[species] = max(merged.get(species, 0), count)
+            else:
+                merged[species] = merged.get(species, 0) + count
+    return merged
 
-        tmp_input = f"/tmp/{base_name}"
-        s3.download_file(bucket, key, tmp_input)
+def _video_range_worker(conn, video_path, start, end, aggregation):
+    # Runs in a spawned process: give each worker one intra-op thread and its own model.
+    import torch
+    torch.set_num_threads(1)
+    try:
+        load_model()
+        conn.send((True, tag_video_range(video_path, start, end, aggregation)))
+    except Exception as e:
+        conn.send((False, repr(e)))
+    finally:
+        conn.close()
 
-        thumbnail_url = None
-        tags = {}
+def tag_video(video_path, aggregation=VIDEO_AGGREGATION, workers=VIDEO_WORKERS):
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    frame_count, _ = probe_video(video_path)
+    if workers == 1 or frame_count < workers * MIN_FRAMES_PER_WORKER:
+        return tag_video_range(video_path, aggregation=aggregation)
 
-        if file_type == "images":
-            img = cv2.imread(tmp_input)
-            if img is None:
-                print(f"Failed to load image: {key}")
-                continue
+    # Lambda has no /dev/shm, so multiprocessing.Pool/Queue are unavailable; use Process + Pipe.
+    ctx = multiprocessing.get_context("spawn")
+    ranges = split_frame_ranges(frame_count, workers)
+    # The last range reads to the end of the stream in case the probed count is short.
+    ranges[-1] = (ranges[-1][0], None)
+    jobs = []
+    for start, end in ranges:
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_video_range_worker,
+                           args=(child_conn, video_path, start, end, aggregation))
+        proc.start()
+        child_conn.close()
+        jobs.append((proc, parent_conn))
+
+    print(f"Tagging {frame_count} frames across {len(jobs)} worker processes")
+    results = []
+    errors = []
+    for proc, conn in jobs:
+        try:
+            ok, payload = conn.recv()
+        except EOFError:
+            ok, payload = False, "worker exited without a result"
+        proc.join()
+        if ok:
+            results.append(payload)
+        else:
+            errors.append(payload)
+    if errors:
+        raise RuntimeError(f"Video range workers failed: {errors}")
+    return merge_range_results(results, aggregation)
 
-            # Create thumbnail
-            thumb = resize_image(img)
-            thumb_name = os.path.splitext(base_name)[0] + "-thumb.jpg"
-            thumb_path = f"/tmp/{thumb_name}"
-            cv2.imwrite(thumb_path, thumb)
+def species_counts(tags):
+    """Numeric tags only: a status marker must not fail the write (and every retry of it)."""
+    counts = {}
+    for species, count in tags.items():
+        if isinstance(count, numbers.Number):
+            counts[species] = int(count)
+        else:
+            print(f"Skipping non-numeric tag {species}={count!r}")
+    return counts
 
-            thumb_key = f"thumbnails/{thumb_name}"
-            s3.upload_file(thumb_path, bucket, thumb_key, ExtraArgs={'ContentType': 'image/jpeg'})
-            thumbnail_url = f"s3://{bucket}/{thumb_key}"
+def write_metadata(bucket, key, file_type, tags, thumbnail_url=None, thumbnails=None, preview_url=None):
+    item = {
+        "file_id": os.path.basename(key),
+        "file_type": file_type,
+        "original_url": f"s3://{bucket}/{key}",
+        "tags": species_counts(tags),
+        "thumbnail_url": thumbnail_url
+    }
+    if thumbnails:
+        item["thumbnails"] = thumbnails
+    if preview_url:
+        item["preview_url"] = preview_url
+    table.put_item(Item=item)
+    print(f"Metadata written to DynamoDB: {item}")
+    return item
 
-            tags = tag_image(img)
+def process_segment(job):
+    """Tag one fan-out segment and record it; the last segment writes the final tags."""
+    load_model()
+    print(f"Segment {job['segment']}/{job['segment_count']} of job {job['job_id']}: "
+          f"{job['start_sec']}s - {job['end_sec']}s")
+    # Signed here rather than by the coordinator: the invocation may start hours after dispatch
+    url = presigned_get_url(job["bucket"], job["key"], FANOUT_URL_EXPIRY)
+    counts = tag_video_range(url, job["start_frame"], job["end_frame"], job["aggregation"])
+    return fanout.record_segment(job, counts, get_partial_store(), reduce_video_job)
 
-        elif file_type == "videos":
-            tags = tag_video(tmp_input)
+def reduce_video_job(job, segment_results):
+    tags = merge_range_results(segment_results, job["aggregation"])
+    target = job["target"]
+    if target.get("content_key"):
+        detection_cache.put_cached_tags(target["content_key"], tags,
+                                        detection_version(target["file_type"], job["aggregation"]))
+    write_metadata(target["bucket"], target["key"], target["file_type"], tags, **target.get("previews", {}))
 
-        elif file_type == "audio":
-            tags = {"status": "audio_processing_pending"}
+partial_store = None
 
+def get_partial_store():
+    global partial_store
+    if partial_store is None:
+        if FANOUT_EXECUTOR == "local":
+            partial_store = fanout.MemoryPartialStore()
         else:
-            print(f"Unsupported file type for key: {key}")
-            continue
+            partial_store = fanout.DynamoPartialStore(FANOUT_PARTIAL_TABLE)
+    return partial_store
 
-        item = {
-            "file_id": base_name,
-            "file_type": file_type,
-            "original_url": f"s3://{bucket}/{key}",
-            "tags": {k: int(v) for k, v in tags.items()},
-            "thumbnail_url": thumbnail_url
-        }
+def get_executor(context):
+    if FANOUT_EXECUTOR == "local":
+        # One worker: the YOLO predictor in this process is not thread-safe
+        return fanout.LocalExecutor(process_segment, max_workers=1)
+    return fanout.LambdaExecutor(FANOUT_FUNCTION_NAME or context.function_name)
+
+def fan_out_video(bucket, key, file_type, context, content_key=None, url=None, previews=None):
+    """
+    Split a long video into segment jobs if it exceeds FANOUT_MIN_SECONDS.
+    Probing and every segment read the object through a pre-signed URL, so
+    OpenCV only fetches the byte ranges it seeks to; each segment signs its own
+    when it starts. Returns True if fanned out.
+    """
+    if FANOUT_MIN_SECONDS <= 0:
+        return False
+    url = url or presigned_get_url(bucket, key, FANOUT_URL_EXPIRY)
+    frame_count, fps = probe_video(url)
+    if not frame_count or not fps or frame_count / fps < FANOUT_MIN_SECONDS:
+        return False
+
+    # Previews are written with the final tags by the reducer
+    target = {"bucket": bucket, "key": key, "file_type": file_type, "content_key": content_key,
+              "previews": previews or {}}
+    jobs = fanout.plan_segments(bucket, key, frame_count, fps, FANOUT_SEGMENT_SECONDS,
+                                VIDEO_AGGREGATION, target)
+    try:
+        get_partial_store().start_job(jobs[0]["job_id"], len(jobs), target)
+    except ClientError as e:
+        # Missing FANOUT_PARTIAL_TABLE or permissions: tag in this invocation instead
+        print(f"Fan-out unavailable, tagging {key} in process: {e}")
+        return False
+    get_executor(context).submit(jobs)
+    print(f"Fanned out {key} ({frame_count / fps:.0f}s) into {len(jobs)} segments")
+    return True
+
+# Ingest stages: one S3 event, one GET and one decode shared by thumbnails and detection
+pipeline = ingest.Pipeline()
+
+def source_url(item):
+    if "url" not in item:
+        item["url"] = presigned_get_url(item["bucket"], item["key"], FANOUT_URL_EXPIRY)
+    return item["url"]
+
+@pipeline.stage("decode")
+def decode_stage(item):
+    def decode():
+        body = s3.get_object(Bucket=item["bucket"], Key=item["key"])["Body"].read()
+        img = cv2.imdecode(np.frombuffer(body, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            print(f"Failed to load image: {item['key']}")
+        return img
+    item["decoder"] = decode
+
+@pipeline.stage("thumbnails")
+def thumbnails_stage(item):
+    bucket, key = item["bucket"], item["key"]
+    if is_current(bucket, marker_key(key), item["source_etag"]):
+        print(f"Thumbnails already current for {key}")
+        thumbnails = rendition_urls(bucket, key)
+    else:
+        img = ingest.pixels(item)
+        if img is None:
+            return False
+        thumbnails = upload_renditions(bucket, key, make_renditions(img), item["source_etag"])
+    item["thumbnails"] = thumbnails
+    item["thumbnail_url"] = default_thumbnail_url(thumbnails)
+
+@pipeline.stage("previews")
+def previews_stage(item):
+    previews = make_video_previews(item["bucket"], item["key"], source_url(item), item["source_etag"],
+                                   detect=item["cached_tags"] is None)
+    item["previews"] = previews
+    item.update(previews)
+
+@pipeline.stage("detection")
+def detection_stage(item):
+    if item["cached_tags"] is not None:
+        item["tags"] = item["cached_tags"]
+        return
 
-        table.put_item(Item=item)
-        print(f"Metadata written to DynamoDB: {item}")
+    file_type = item["file_type"]
+    if file_type == "images":
+        img = ingest.pixels(item)
+        if img is None:
+            return False
+        load_model()
+        item["tags"] = tag_image(img)
+    elif file_type == "videos":
+        # Long videos are tagged by segment invocations; the reducer writes the metadata
+        if fan_out_video(item["bucket"], item["key"], file_type, item["context"], item["content_key"],
+                         source_url(item), item.get("previews")):
+            return False
+        tmp_input = f"/tmp/{os.path.basename(item['key'])}"
+        s3.download_file(item["bucket"], item["key"], tmp_input)
+        load_model()
+        item["tags"] = tag_video(tmp_input)
+    else:
+        print(f"No detector for {file_type}, writing {item['key']} without tags")
+        item["tags"] = {}
+        return
+    detection_cache.put_cached_tags(item["content_key"], item["tags"], detection_version(file_type))
+
+@pipeline.stage("metadata")
+def metadata_stage(item):
+    write_metadata(item["bucket"], item["key"], item["file_type"], item.get("tags", {}),
+                   item.get("thumbnail_url"), item.get("thumbnails"), item.get("preview_url"))
+
+def process_record(record, context):
+    """Run one S3 record through the ingest stages for its prefix."""
+    bucket = record['s3']['bucket']['name']
+    key = unquote_plus(record['s3']['object']['key'])
+    file_type = key.split('/')[0].lower()
+    if not pipeline.stages_for(file_type):
+        print(f"Unsupported file type for key: {key}")
+        return
+
+    source_etag, size = s3_object_identity(bucket, key, record)
+    content_key = s3_content_key(source_etag, size)
+    cached_tags = detection_cache.get_cached_tags(content_key, detection_version(file_type))
+    if cached_tags is not None:
+        print(f"Detection cache hit for {key}")
+
+    pipeline.run({
+        "bucket": bucket,
+        "key": key,
+        "file_type": file_type,
+        "source_etag": source_etag,
+        "content_key": content_key,
+        "cached_tags": cached_tags,
+        "context": context,
+    })
+
+def lambda_handler(event, context):
+    if "segment_job" in event:
+        return {"statusCode": 200, "body": json.dumps({"reduced": process_segment(event["segment_job"])})}
+
+    # Uploads buffered through SQS: many objects per warm container, failed messages retried alone
+    if sqs_ingest.is_sqs_event(event):
+        return sqs_ingest.process_sqs_event(event, lambda record: process_record(record, context))
+
+    for record in event['Records']:
+        process_record(record, context)
 
     return {
         "statusCode": 200,
@@ -0,0 +1,222 @@
+"""
+Fan-out of long video tagging across several Lambda invocations.
+
+The coordinator splits a video into segment jobs by timestamp range and hands
+them to an executor. Each segment tags its own range (seeking into the video
+over a pre-signed URL it signs when it starts, since an asynchronous invocation
+can be delayed for hours), records its counts in a partial-results store, and the
+segment that completes the job runs the reducer which writes the final tags.
+
+LambdaExecutor dispatches segments as asynchronous invocations; LocalExecutor
+runs the same segment handler in a thread or process pool so the whole flow
+can be exercised offline together with MemoryPartialStore.
+"""
+import json
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+# Header item that tracks progress of a job; segment items use segment >= 0
+HEADER_SEGMENT = -1
+PARTIAL_TTL_SECONDS = 24 * 3600
+
+
+def plan_segments(bucket, key, frame_count, fps, segment_seconds, aggregation, target, job_id=None):
+    """Split a video into jobs of roughly `segment_seconds` each."""
+    job_id = job_id or uuid.uuid4().hex
+    fps = fps if fps and fps > 0 else 30.0
+    frames_per_segment = max(1, int(round(segment_seconds * fps)))
+    segment_count = max(1, math.ceil(frame_count / frames_per_segment))
+
+    jobs = []
+    for i in range(segment_count):
+        start_frame = i * frames_per_segment
+        # The last segment reads to the end in case the probed frame count is short
+        end_frame = None if i == segment_count - 1 else start_frame + frames_per_segment
+        jobs.append({
+            "job_id": job_id,
+            "segment": i,
+            "segment_count": segment_count,
+            "bucket": bucket,
+            "key": key,
+            "start_frame": start_frame,
+            "end_frame": end_frame,
+            "start_sec": round(start_frame / fps, 3),
+            "end_sec": None if end_frame is None else round(end_frame / fps, 3),
+            "aggregation": aggregation,
+            "target": target,
+        })
+    return jobs
+
+
+def record_segment(job, counts, store, reducer):
+    """
+    Store one segment's counts; if no segment is outstanding any more, run the reducer.
+    A redelivered segment still checks completion, so a retry after a crash between
+    storing the last segment and reducing finishes the job. Returns True when this
+    call produced the final result.
+    """
+    recorded, completed = store.put_segment(job, counts)
+    if not recorded:
+        print(f"Segment {job['segment']} of job {job['job_id']} already recorded")
+    print(f"Job {job['job_id']}: {completed}/{job['segment_count']} segments done")
+    if completed < job["segment_count"] or not store.claim_reduce(job["job_id"]):
+        return False
+    reducer(job, store.get_segments(job["job_id"]))
+    return True
+
+
+class DynamoPartialStore:
+    """Partial results in a DynamoDB table keyed by (job_id, segment)."""
+
+    def __init__(self, table_name):
+        self.table = boto3.resource("dynamodb").Table(table_name)
+
+    def start_job(self, job_id, segment_count, target):
+        self.table.put_item(Item={
+            "job_id": job_id,
+            "segment": HEADER_SEGMENT,
+            "segment_count": segment_count,
+            "target": json.dumps(target),
+            "ttl": int(time.time()) + PARTIAL_TTL_SECONDS,
+        })
+
+    def put_segment(self, job, counts):
+        """
+        Store a segment once; returns (recorded, completed segments). Completion is
+        counted from the segment items themselves rather than kept in a separate
+        counter, so there is no second write that a crash could lose.
+        """
+        recorded = True
+        try:
+            self.table.put_item(
+                Item={
+                    "job_id": job["job_id"],
+                    "segment": job["segment"],
+                    "tags": {k: int(v) for k, v in counts.items()},
+                    "ttl": int(time.time()) + PARTIAL_TTL_SECONDS,
+                },
+                ConditionExpression="attribute_not_exists(job_id)",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            recorded = False
+        return recorded, self.count_segments(job["job_id"])
+
+    def count_segments(self, job_id):
+        completed = 0
+        kwargs = {
+            "KeyConditionExpression": "job_id = :j AND segment >= :zero",
+            "ExpressionAttributeValues": {":j": job_id, ":zero": 0},
+            "Select": "COUNT",
+            "ConsistentRead": True,
+        }
+        while True:
+            response = self.table.query(**kwargs)
+            completed += response["Count"]
+            if "LastEvaluatedKey" not in response:
+                return completed
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def claim_reduce(self, job_id):
+        try:
+            self.table.update_item(
+                Key={"job_id": job_id, "segment": HEADER_SEGMENT},
+                UpdateExpression="SET reduced = :yes",
+                ConditionExpression="attribute_not_exists(reduced)",
+                ExpressionAttributeValues={":yes": True},
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def get_segments(self, job_id):
+        results = []
+        kwargs = {
+            "KeyConditionExpression": "job_id = :j AND segment >= :zero",
+            "ExpressionAttributeValues": {":j": job_id, ":zero": 0},
+            "ConsistentRead": True,
+        }
+        while True:
+            response = self.table.query(**kwargs)
+            for item in response.get("Items", []):
+                results.append({k: int(v) for k, v in item.get("tags", {}).items()})
+            if "LastEvaluatedKey" not in response:
+                return results
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+class MemoryPartialStore:
+    """In-process stand-in for DynamoPartialStore, safe to share between threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def start_job(self, job_id, segment_count, target):
+        with self.lock:
+            self.jobs[job_id] = {"segment_count": segment_count, "target": target,
+                                 "segments": {}, "reduced": False}
+
+    def put_segment(self, job, counts):
+        with self.lock:
+            segments = self.jobs[job["job_id"]]["segments"]
+            recorded = job["segment"] not in segments
+            if recorded:
+                segments[job["segment"]] = dict(counts)
+            return recorded, len(segments)
+
+    def claim_reduce(self, job_id):
+        with self.lock:
+            if self.jobs[job_id]["reduced"]:
+                return False
+            self.jobs[job_id]["reduced"] = True
+            return True
+
+    def get_segments(self, job_id):
+        with self.lock:
+            segments = self.jobs[job_id]["segments"]
+            return [segments[i] for i in sorted(segments)]
+
+
+class LambdaExecutor:
+    """Dispatch each segment job as an asynchronous invocation of `function_name`."""
+
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.client = boto3.client("lambda")
+
+    def submit(self, jobs):
+        for job in jobs:
+            self.client.invoke(
+                FunctionName=self.function_name,
+                InvocationType="Event",
+                Payload=json.dumps({"segment_job": job}).encode("utf-8"),
+            )
+        print(f"Dispatched {len(jobs)} segment invocations to {self.function_name}")
+
+
+class LocalExecutor:
+    """
+    Run `handler(job)` for every job in a local pool and wait for completion.
+    With use_processes=True the store used by the handler must be reachable from
+    the worker processes (DynamoPartialStore), MemoryPartialStore is per process.
+    """
+
+    def __init__(self, handler, max_workers=None, use_processes=False):
+        self.handler = handler
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+
+    def submit(self, jobs):
+        pool_cls = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with pool_cls(max_workers=self.max_workers) as pool:
+            return list(pool.map(self.handler, jobs))
@@ -0,0 +1,72 @@
+"""
+Single-decode ingest pipeline.
+
+Every uploaded object becomes an `item` dict that flows through the stages
+enabled for its prefix (images/, videos/). Stages share whatever the
+earlier ones produced, most importantly the decoded pixels: the "decode" stage
+only installs a decoder, and the object is fetched and decoded the first time a
+later stage asks for pixels(item). A re-delivered image whose thumbnails and
+tags are already current is therefore never downloaded at all.
+
+Stages are enabled per prefix with INGEST_STAGES, for example
+    images=decode,thumbnails,detection,metadata;videos=previews,detection,metadata
+Prefixes that are not mentioned keep their defaults, an empty list disables a prefix.
+audio has no stages by default: BirdNET tagging and its metadata write happen in
+audio_tagging, which this Lambda has no detector for.
+A stage returning False stops the pipeline for that item (e.g. a video handed to fan-out).
+"""
+import os
+
+DEFAULT_STAGES = {
+    "images": ["decode", "thumbnails", "detection", "metadata"],
+    "videos": ["previews", "detection", "metadata"],
+    "audio": [],
+}
+
+
+def parse_stage_config(text, defaults=DEFAULT_STAGES):
+    """Parse 'prefix=stage,stage;prefix=...' into {prefix: [stage, ...]} on top of the defaults."""
+    config = {prefix: list(stages) for prefix, stages in defaults.items()}
+    for part in (text or "").split(";"):
+        if not part.strip():
+            continue
+        prefix, _, stages = part.partition("=")
+        config[prefix.strip().lower()] = [s.strip() for s in stages.split(",") if s.strip()]
+    return config
+
+
+def pixels(item):
+    """Decoded image of the item, fetched and decoded on first use. None if undecodable or no decode stage."""
+    if "image" not in item:
+        decoder = item.get("decoder")
+        item["image"] = decoder() if decoder else None
+    return item["image"]
+
+
+class Pipeline:
+    """Stage registry plus the per-prefix stage lists."""
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else parse_stage_config(os.environ.get("INGEST_STAGES"))
+        self.stages = {}
+
+    def stage(self, name):
+        """Decorator registering `fn(item)` as stage `name`."""
+        def register(fn):
+            self.stages[name] = fn
+            return fn
+        return register
+
+    def stages_for(self, file_type):
+        return self.config.get(file_type) or []
+
+    def run(self, item):
+        names = self.stages_for(item["file_type"])
+        unknown = [name for name in names if name not in self.stages]
+        if unknown:
+            raise ValueError(f"Unknown ingest stage(s) for {item['file_type']}: {', '.join(unknown)}")
+        for name in names:
+            if self.stages[name](item) is False:
+                print(f"Ingest of {item['key']} stopped after stage {name}")
+                return False
+        return True
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# Module-level boto3 resources need a region even though the tests never call AWS
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+# The Lambda modules are flat files next to this directory, plus the shared ones in common/
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "common"))
+sys.path.insert(0, HERE)
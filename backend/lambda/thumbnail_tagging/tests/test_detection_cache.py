@@ -0,0 +1,58 @@
+import detection_cache
+
+
+class FakeTable:
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, Key):
+        item = self.items.get(Key["content_key"])
+        return {"Item": item} if item else {}
+
+    def put_item(self, Item):
+        self.items[Item["content_key"]] = Item
+
+
+def use_fake_table(monkeypatch):
+    table = FakeTable()
+    monkeypatch.setattr(detection_cache, "cache_table", table)
+    monkeypatch.setattr(detection_cache, "entries", detection_cache.OrderedDict())
+    return table
+
+
+def test_hit_only_for_the_same_version(monkeypatch):
+    use_fake_table(monkeypatch)
+    detection_cache.put_cached_tags("etag:a:1", {"owl": 2}, "weights@1")
+
+    assert detection_cache.get_cached_tags("etag:a:1", "weights@1") == {"owl": 2}
+    # Retrained weights get a new ETag
+    assert detection_cache.get_cached_tags("etag:a:1", "weights@2") is None
+
+
+def test_video_aggregation_is_part_of_the_version(monkeypatch):
+    use_fake_table(monkeypatch)
+    version = detection_cache.cache_version("weights@1", "max")
+    detection_cache.put_cached_tags("etag:v:1", {"owl": 3}, version)
+
+    assert detection_cache.get_cached_tags("etag:v:1", version) == {"owl": 3}
+    assert detection_cache.get_cached_tags("etag:v:1", detection_cache.cache_version("weights@1", "sum")) is None
+
+
+def test_table_entry_is_used_after_the_lru_is_cold(monkeypatch):
+    table = use_fake_table(monkeypatch)
+    detection_cache.put_cached_tags("etag:a:1", {"owl": 1}, "weights@1")
+    detection_cache.entries.clear()
+
+    assert detection_cache.get_cached_tags("etag:a:1", "weights@1") == {"owl": 1}
+    assert "etag:a:1" in table.items
+
+
+def test_file_weights_version_follows_the_contents(tmp_path):
+    weights = tmp_path / "model.pt"
+    weights.write_bytes(b"one")
+    first = detection_cache.file_weights_version(str(weights))
+    other = tmp_path / "other.pt"
+    other.write_bytes(b"two")
+
+    assert first.startswith("sha256:")
+    assert detection_cache.file_weights_version(str(other)) != first
@@ -0,0 +1,68 @@
+import threading
+
+import fanout
+
+
+def make_jobs(frame_count=3000, fps=30.0, segment_seconds=20):
+    return fanout.plan_segments("bucket", "videos/long.mp4", frame_count, fps, segment_seconds, "sum",
+                                {"key": "videos/long.mp4"}, job_id="job-1")
+
+
+def run_fan_out(jobs, store, max_workers=4):
+    reductions = []
+    lock = threading.Lock()
+
+    def reducer(job, segment_results):
+        with lock:
+            reductions.append(segment_results)
+
+    def handler(job):
+        counts = {"owl": job["segment"] + 1}
+        return fanout.record_segment(job, counts, store, reducer)
+
+    store.start_job(jobs[0]["job_id"], len(jobs), jobs[0]["target"])
+    results = fanout.LocalExecutor(handler, max_workers=max_workers).submit(jobs)
+    return results, reductions, handler
+
+
+def test_plan_segments_covers_the_video():
+    jobs = make_jobs()
+    assert len(jobs) == 5
+    assert [j["start_frame"] for j in jobs] == [0, 600, 1200, 1800, 2400]
+    assert jobs[-1]["end_frame"] is None
+    assert all(j["segment_count"] == 5 for j in jobs)
+    assert all((j["bucket"], j["key"]) == ("bucket", "videos/long.mp4") for j in jobs)
+
+
+def test_fan_out_is_reduced_exactly_once():
+    jobs = make_jobs()
+    store = fanout.MemoryPartialStore()
+    results, reductions, _ = run_fan_out(jobs, store)
+
+    assert results.count(True) == 1
+    assert len(reductions) == 1
+    assert sorted(r["owl"] for r in reductions[0]) == [1, 2, 3, 4, 5]
+
+
+def test_redelivered_segment_does_not_reduce_again():
+    jobs = make_jobs()
+    store = fanout.MemoryPartialStore()
+    _, reductions, handler = run_fan_out(jobs, store)
+
+    assert handler(jobs[2]) is False
+    assert len(reductions) == 1
+
+
+def test_retry_after_crash_before_reduce_finishes_the_job():
+    jobs = make_jobs()
+    store = fanout.MemoryPartialStore()
+    store.start_job("job-1", len(jobs), jobs[0]["target"])
+    reductions = []
+    for job in jobs[:-1]:
+        fanout.record_segment(job, {"owl": 1}, store, lambda j, r: reductions.append(r))
+    # The last segment was stored, then its invocation died before reducing
+    store.put_segment(jobs[-1], {"owl": 1})
+
+    assert fanout.record_segment(jobs[-1], {"owl": 1}, store, lambda j, r: reductions.append(r))
+    assert len(reductions) == 1
+    assert len(reductions[0]) == len(jobs)
@@ -0,0 +1,14 @@
+import ingest
+
+
+def test_audio_has_no_default_stages():
+    pipeline = ingest.Pipeline(ingest.parse_stage_config(""))
+    assert pipeline.stages_for("audio") == []
+    assert pipeline.stages_for("videos") == ["previews", "detection", "metadata"]
+
+
+def test_stage_config_overrides_only_named_prefixes():
+    config = ingest.parse_stage_config("images=decode,metadata; audio=")
+    assert config["images"] == ["decode", "metadata"]
+    assert config["audio"] == []
+    assert config["videos"] == ingest.DEFAULT_STAGES["videos"]
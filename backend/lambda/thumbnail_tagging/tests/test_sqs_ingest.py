@@ -0,0 +1,52 @@
+import json
+
+import sqs_ingest
+
+
+def make_handler(fail_keys, seen):
+    def handle_record(record):
+        key = record["s3"]["object"]["key"]
+        seen.append(key)
+        if key in fail_keys:
+            raise ValueError(f"cannot process {key}")
+
+    def handler(event, context):
+        return sqs_ingest.process_sqs_event(event, handle_record)
+    return handler
+
+
+def test_s3_records_unwraps_sns_and_ignores_test_events():
+    body = sqs_ingest.s3_event_body("bucket", "images/a.jpg")
+    assert sqs_ingest.s3_records({"body": body})[0]["s3"]["object"]["key"] == "images/a.jpg"
+    wrapped = json.dumps({"Type": "Notification", "Message": body})
+    assert sqs_ingest.s3_records({"body": wrapped})[0]["s3"]["object"]["key"] == "images/a.jpg"
+    assert sqs_ingest.s3_records({"body": json.dumps({"Event": "s3:TestEvent"})}) == []
+
+
+def test_partial_batch_failure_retries_only_the_failed_message():
+    queue = sqs_ingest.MemoryQueue(batch_size=4, batch_window=0)
+    for i in range(4):
+        queue.send_s3_event("bucket", f"images/{i}.jpg")
+    seen = []
+    event = queue.receive()
+    response = make_handler({"images/2.jpg"}, seen)(event, None)
+
+    assert sqs_ingest.is_sqs_event(event)
+    assert len(response["batchItemFailures"]) == 1
+    queue.acknowledge(event, response)
+    assert len(queue) == 1
+    assert sqs_ingest.s3_records(queue.receive()["Records"][0])[0]["s3"]["object"]["key"] == "images/2.jpg"
+
+
+def test_failing_message_ends_in_dead_letters():
+    queue = sqs_ingest.MemoryQueue(batch_size=3, batch_window=0, max_receive_count=3)
+    for i in range(5):
+        queue.send_s3_event("bucket", f"images/{i}.jpg")
+    seen = []
+    queue.drain(make_handler({"images/4.jpg"}, seen))
+
+    assert len(queue) == 0
+    assert len(queue.dead_letters) == 1
+    assert json.loads(queue.dead_letters[0]["body"])["Records"][0]["s3"]["object"]["key"] == "images/4.jpg"
+    assert seen.count("images/4.jpg") == 3
+    assert all(seen.count(f"images/{i}.jpg") == 1 for i in range(4))
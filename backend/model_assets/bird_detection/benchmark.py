@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Reproducible benchmark for the bird detection path.
+
+Measures model load time, per-image latency (p50/p95), throughput at several
+batch sizes, peak RSS and per-species detection counts over ./test_images
+(and optional videos), and writes the results to a JSON baseline.
+
+    python benchmark.py -o baseline.json
+    python benchmark.py --compare baseline.json --latency-tolerance 0.15
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import cv2 as cv
+import numpy as np
+
+from birds_detection import Detector, IMAGE_EXTENSIONS, species_counts
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile_ms(samples, q):
+    return round(float(np.percentile(samples, q)) * 1000, 2)
+
+
+def load_images(image_dir):
+    paths = sorted(p for p in glob.glob(os.path.join(image_dir, "*")) if p.lower().endswith(IMAGE_EXTENSIONS))
+    images = []
+    for path in paths:
+        img = cv.imread(path)
+        if img is None:
+            print(f"Skipping unreadable image {path}")
+            continue
+        images.append((path, img))
+    return images
+
+
+def run_benchmark(model, image_dir, videos=(), batch_sizes=(1, 4, 8), repeats=3, confidence=0.5):
+    started = time.perf_counter()
+    detector = Detector(model, confidence)
+    load_seconds = time.perf_counter() - started
+
+    # Images are decoded up front so the timings cover inference only
+    images = load_images(image_dir)
+    if not images:
+        raise SystemExit(f"No images found in {image_dir}")
+    frames = [img for _, img in images]
+
+    # Warm-up pass: the first call pays for lazy initialisation
+    detector.model(frames[0], verbose=False)
+
+    latencies = []
+    for _ in range(repeats):
+        for img in frames:
+            t0 = time.perf_counter()
+            detector.model(img, verbose=False)
+            latencies.append(time.perf_counter() - t0)
+
+    throughput = {}
+    for batch_size in batch_sizes:
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            for start in range(0, len(frames), batch_size):
+                detector.model(frames[start:start + batch_size], verbose=False)
+        throughput[str(batch_size)] = round(len(frames) * repeats / (time.perf_counter() - t0), 2)
+
+    # Detection counts use the same records as the detections-only output
+    records = []
+    for path, _ in images:
+        records.extend(dict(r, frame=path) for r in detector.detect_image(path) or [])
+    counts = species_counts(records, confidence, "sum")
+
+    video_results = {}
+    for video in videos:
+        t0 = time.perf_counter()
+        video_records = detector.detect_video(video) or []
+        elapsed = time.perf_counter() - t0
+        frame_count = len({r["frame"] for r in video_records})
+        video_results[os.path.basename(video)] = {
+            "seconds": round(elapsed, 3),
+            "frames_with_detections": frame_count,
+            "counts": species_counts(video_records, confidence, "tracks"),
+        }
+
+    return {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "model": os.path.abspath(model),
+        },
+        "images": len(frames),
+        "repeats": repeats,
+        "model_load_seconds": round(load_seconds, 3),
+        "latency_ms": {"p50": percentile_ms(latencies, 50), "p95": percentile_ms(latencies, 95)},
+        "images_per_second": throughput,
+        "peak_rss_mb": peak_rss_mb(),
+        "species_counts": dict(sorted(counts.items())),
+        "videos": video_results,
+    }
+
+
+def compare(current, baseline, latency_tolerance=0.15, count_tolerance=0):
+    """
+    Return a list of regressions of `current` against `baseline`.
+
+    latency_tolerance is the allowed relative slowdown (0.15 = 15%) of latency,
+    load time and throughput; count_tolerance is the allowed absolute drift of
+    any species count, over the images and per baseline video.
+    """
+    problems = []
+    for q in ("p50", "p95"):
+        old, new = baseline["latency_ms"][q], current["latency_ms"][q]
+        if new > old * (1 + latency_tolerance):
+            problems.append(f"latency {q}: {old} ms -> {new} ms")
+
+    old, new = baseline["model_load_seconds"], current["model_load_seconds"]
+    if new > old * (1 + latency_tolerance):
+        problems.append(f"model load: {old} s -> {new} s")
+
+    for batch_size, old in baseline["images_per_second"].items():
+        new = current["images_per_second"].get(batch_size)
+        if new is not None and new < old / (1 + latency_tolerance):
+            problems.append(f"throughput batch={batch_size}: {old} -> {new} images/s")
+
+    problems.extend(count_drift("", baseline["species_counts"], current["species_counts"], count_tolerance))
+
+    # Video counts go through the frame aggregation, so they catch regressions there
+    for video, old_video in sorted(baseline.get("videos", {}).items()):
+        new_video = current.get("videos", {}).get(video)
+        if new_video is None:
+            problems.append(f"video {video}: in the baseline but not benchmarked")
+            continue
+        problems.extend(count_drift(f"video {video} ", old_video["counts"], new_video["counts"], count_tolerance))
+    return problems
+
+
+def count_drift(label, old_counts, new_counts, count_tolerance):
+    problems = []
+    for species in sorted(set(old_counts) | set(new_counts)):
+        old, new = old_counts.get(species, 0), new_counts.get(species, 0)
+        if abs(new - old) > count_tolerance:
+            problems.append(f"{label}count drift {species}: {old} -> {new}")
+    return problems
+
+
+def main(argv=None):
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Benchmark the bird detection model.")
+    parser.add_argument("-m", "--model", default=os.path.join(here, "model.pt"))
+    parser.add_argument("-i", "--images", default=os.path.join(here, "test_images"))
+    parser.add_argument("-v", "--video", action="append", default=[], help="Optional video, may repeat.")
+    parser.add_argument("-b", "--batch-sizes", default="1,4,8")
+    parser.add_argument("-r", "--repeats", type=int, default=3)
+    parser.add_argument("-c", "--confidence", type=float, default=0.5)
+    parser.add_argument("-o", "--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Baseline JSON to check the new results against.")
+    parser.add_argument("--latency-tolerance", type=float, default=0.15)
+    parser.add_argument("--count-tolerance", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    # Read the baseline before anything is written, so --output cannot clobber it
+    baseline = None
+    if args.compare:
+        if os.path.abspath(args.compare) == os.path.abspath(args.output):
+            parser.error("--compare and --output must be different files")
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    batch_sizes = [int(b) for b in args.batch_sizes.split(",") if b]
+    results = run_benchmark(args.model, args.images, args.video, batch_sizes, args.repeats, args.confidence)
+    print(json.dumps(results, indent=2))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if baseline is not None:
+        problems = compare(results, baseline, args.latency_tolerance, args.count_tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}")
+        if problems:
+            return 1
+        print("No regressions against baseline.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
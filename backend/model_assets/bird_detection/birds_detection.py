@@ -11,78 +11,506 @@ import numpy as np
 import matplotlib.pyplot as plt
 import os
 import requests
-
-def image_prediction(image_path, result_filename=None, save_dir = "./image_prediction_results", confidence=0.5, model="./model.pt"):
+import argparse
+import glob
+import json
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+_END_OF_STREAM = object()
+
+
+class _PipelineQueue:
+    """Bounded queue between two pipeline stages that records its occupancy."""
+
+    def __init__(self, maxsize, stop):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.maxsize = maxsize
+        self.stop = stop
+        self.samples = 0
+        self.total = 0
+        self.peak = 0
+
+    def put(self, item):
+        """Block until there is room; returns False if the pipeline was stopped."""
+        while True:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                if self.stop.is_set():
+                    return False
+
+    def get(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return _END_OF_STREAM
+                continue
+            size = self.queue.qsize() + 1
+            self.samples += 1
+            self.total += size
+            self.peak = max(self.peak, size)
+            return item
+
+    def occupancy(self):
+        mean = self.total / self.samples if self.samples else 0.0
+        return {"mean": round(mean, 2), "peak": self.peak, "capacity": self.maxsize}
+
+
+class Detector:
     """
-    Function to display predictions of a pre-trained YOLO model on a given image.
+    YOLO bird detector that loads the model once and reuses it for every prediction.
+
+    Annotators depend only on the frame resolution, so they are built once per
+    resolution and cached.
 
     Parameters:
-        image_path (str): Path to the image file. Can be a local path or a URL.
-        result_path (str): If not None, this is the output filename.
-        confidence (float): 0-1, only results over this value are saved.
         model (str): path to the model.
+        confidence (float): 0-1, default threshold for kept detections.
     """
 
-    # Load YOLO model
-    model = YOLO(model)
-    class_dict = model.names
-
-    # Load image from local path
-    img = cv.imread(image_path)
-
-    # Check if image was loaded successfully
-    if img is None:
-        print("Couldn't load the image! Please check the image path.")
-        return
-
-    # Get image dimensions
-    h, w = img.shape[:2]
+    def __init__(self, model="./model.pt", confidence=0.5):
+        self.model = YOLO(model)
+        self.class_dict = self.model.names
+        self.confidence = confidence
+        self.color_palette = sv.ColorPalette.from_matplotlib('magma', 10)
+        self._image_annotators = {}
+        self._video_annotators = {}
+
+    def image_annotators(self, resolution_wh):
+        """Return the (box, label) annotators for still images of this resolution."""
+        if resolution_wh not in self._image_annotators:
+            thickness = sv.calculate_optimal_line_thickness(resolution_wh=resolution_wh)
+            text_scale = sv.calculate_optimal_text_scale(resolution_wh=resolution_wh)
+            box_annotator = sv.BoxAnnotator(thickness=thickness, color=self.color_palette)
+            label_annotator = sv.LabelAnnotator(color=self.color_palette, text_scale=text_scale,
+                                                text_thickness=thickness,
+                                                text_position=sv.Position.TOP_LEFT)
+            self._image_annotators[resolution_wh] = (box_annotator, label_annotator)
+        return self._image_annotators[resolution_wh]
+
+    def video_annotators(self, resolution_wh):
+        """Return the (box, label) annotators for video frames, coloured by track."""
+        if resolution_wh not in self._video_annotators:
+            thickness = sv.calculate_optimal_line_thickness(resolution_wh=resolution_wh)
+            text_scale = sv.calculate_optimal_text_scale(resolution_wh=resolution_wh)
+            box_annotator = sv.BoxAnnotator(thickness=thickness, color_lookup=sv.ColorLookup.TRACK)
+            label_annotator = sv.LabelAnnotator(text_scale=text_scale, text_thickness=thickness,
+                                                text_position=sv.Position.TOP_LEFT,
+                                                color_lookup=sv.ColorLookup.TRACK)
+            self._video_annotators[resolution_wh] = (box_annotator, label_annotator)
+        return self._video_annotators[resolution_wh]
+
+    def _annotate_image(self, img, result, confidence):
+        """Filter a YOLO result by confidence and draw it onto img in place."""
+        detections = sv.Detections.from_ultralytics(result)
+
+        # Filter detections based on confidence threshold and check if any exist
+        if detections.class_id is not None:
+            detections = detections[(detections.confidence > confidence)]
+
+            # Create labels for the detected objects
+            labels = [f"{self.class_dict[cls_id]} {conf*100:.2f}%" for cls_id, conf in
+                      zip(detections.class_id, detections.confidence)]
+
+            # Annotate the image with boxes and labels
+            h, w = img.shape[:2]
+            box_annotator, label_annotator = self.image_annotators((w, h))
+            box_annotator.annotate(img, detections=detections)
+            label_annotator.annotate(img, detections=detections, labels=labels)
+        return detections
+
+    @staticmethod
+    def _save_image(img, result_filename, save_dir):
+        if result_filename:
+            os.makedirs(save_dir, exist_ok=True)  # Ensure the save directory exists
+            save_path = os.path.join(save_dir, result_filename)
+            try:
+                status = cv.imwrite(save_path, img)
+                print(f"Image save status = {status}.")
+            except Exception as e:
+                print(f"Error saving image: {e}")
+        else:
+            print("Filename is none, result is not saved.")
+
+    def predict_image(self, image_path, result_filename=None, save_dir="./image_prediction_results",
+                      confidence=None):
+        """
+        Run the model on one image, annotate it and optionally save the result.
+
+        Parameters:
+            image_path (str): Path to the image file.
+            result_filename (str): If not None, this is the output filename.
+            save_dir (str): Directory the annotated image is written to.
+            confidence (float): 0-1, overrides the detector's default threshold.
+
+        Returns:
+            sv.Detections kept after filtering, or None if the image couldn't be loaded.
+        """
+        confidence = self.confidence if confidence is None else confidence
+
+        # Load image from local path
+        img = cv.imread(image_path)
+
+        # Check if image was loaded successfully
+        if img is None:
+            print("Couldn't load the image! Please check the image path.")
+            return None
+
+        result = self.model(img)[0]
+        detections = self._annotate_image(img, result, confidence)
+        self._save_image(img, result_filename, save_dir)
+        return detections
+
+    def predict_images(self, image_paths, result_filenames=None, save_dir="./image_prediction_results",
+                       confidence=None, batch_size=8):
+        """
+        Run the model on several images, batch_size images per forward pass.
+
+        Parameters:
+            image_paths (list): Paths to the image files.
+            result_filenames (list): Output filenames matching image_paths, or None to skip saving.
+            save_dir (str): Directory the annotated images are written to.
+            confidence (float): 0-1, overrides the detector's default threshold.
+            batch_size (int): Number of images passed to the model at once.
+
+        Returns:
+            list of sv.Detections (None for images that couldn't be loaded), in input order.
+        """
+        confidence = self.confidence if confidence is None else confidence
+        result_filenames = result_filenames or [None] * len(image_paths)
+        outputs = [None] * len(image_paths)
+
+        for batch_start in range(0, len(image_paths), batch_size):
+            batch = []
+            for i in range(batch_start, min(batch_start + batch_size, len(image_paths))):
+                img = cv.imread(image_paths[i])
+                if img is None:
+                    print(f"Couldn't load the image {image_paths[i]}! Please check the image path.")
+                    continue
+                batch.append((i, img))
+            if not batch:
+                continue
+
+            results = self.model([img for _, img in batch])
+            for (i, img), result in zip(batch, results):
+                outputs[i] = self._annotate_image(img, result, confidence)
+                self._save_image(img, result_filenames[i], save_dir)
+        return outputs
+
+    def predict_video(self, video_path, result_filename=None, save_dir="./video_prediction_results",
+                      confidence=None, codec="XVID", queue_size=32):
+        """
+        Make predictions on video frames, track the detected birds and save the annotated video.
+
+        Reading, inference (model + tracker) and annotate/write run as three threads
+        joined by bounded queues, so decoding and encoding overlap with the model.
+        Each stage is a single thread, so frame order is preserved.
+
+        Parameters:
+            video_path (str): Path to the video file.
+            result_filename (str): The name of the output video file, required.
+            save_dir (str): Directory the annotated video is written to.
+            confidence (float): 0-1, overrides the detector's default threshold.
+            codec (str): FourCC of the output writer, e.g. "XVID", "mp4v" or "MJPG".
+            queue_size (int): Capacity of each queue between stages.
+
+        Returns:
+            dict with the number of frames processed, distinct tracks per species and
+            pipeline stats (fps, per-stage busy time and queue occupancy), or None on error.
+        """
+        confidence = self.confidence if confidence is None else confidence
+        if not result_filename:
+            print("Result filename is required to save the video file.")
+            return None
 
-    # Calculate optimal thickness for boxes and text based on image resolution
-    thickness = sv.calculate_optimal_line_thickness(resolution_wh=(w, h))
-    text_scale = sv.calculate_optimal_text_scale(resolution_wh=(w, h))
+        # Load video info and extract width, height, and frames per second (fps)
+        video_info = sv.VideoInfo.from_video_path(video_path=video_path)
+        w, h, fps = int(video_info.width), int(video_info.height), int(video_info.fps)
 
-    # Set up color palette for annotations
-    color_palette = sv.ColorPalette.from_matplotlib('magma', 10)
+        box_annotator, label_annotator = self.video_annotators(video_info.resolution_wh)
+        tracker = sv.ByteTrack(frame_rate=fps)  # Initialize the tracker with the video's frame rate
 
-    # Create box and label annotators
-    box_annotator = sv.BoxAnnotator(thickness=thickness, color=color_palette)
-    label_annotator = sv.LabelAnnotator(color=color_palette, text_scale=text_scale, 
-                                        text_thickness=thickness, 
-                                        text_position=sv.Position.TOP_LEFT)
+        # Capture the video from the given path
+        cap = cv.VideoCapture(video_path)
+        if not cap.isOpened():
+            print("Error: couldn't open the video!")
+            return None
 
-    # Run the model on the image
-    result = model(img)[0]
+        os.makedirs(save_dir, exist_ok=True)  # Ensure save directory exists
+        save_path = os.path.join(save_dir, result_filename)
+        out = cv.VideoWriter(save_path, cv.VideoWriter_fourcc(*codec), fps, (w, h))  # Initialize video writer
+
+        stop = threading.Event()
+        frame_queue = _PipelineQueue(queue_size, stop)
+        result_queue = _PipelineQueue(queue_size, stop)
+        busy = {"read": 0.0, "inference": 0.0, "write": 0.0}
+        errors = []
+        tracks = {}
+        frames = [0]
+
+        def run_stage(name, body):
+            try:
+                body()
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+                stop.set()
+
+        def read():
+            try:
+                while not stop.is_set():
+                    started = time.perf_counter()
+                    ret, frame = cap.read()
+                    busy["read"] += time.perf_counter() - started
+                    if not ret:  # End of the video
+                        break
+                    if not frame_queue.put(frame):
+                        break
+            finally:
+                frame_queue.put(_END_OF_STREAM)
+
+        def infer():
+            try:
+                while True:
+                    frame = frame_queue.get()
+                    if frame is _END_OF_STREAM:
+                        break
+                    started = time.perf_counter()
+                    # Make predictions on the current frame and track detected objects
+                    result = self.model(frame, verbose=False)[0]
+                    detections = sv.Detections.from_ultralytics(result)
+                    detections = tracker.update_with_detections(detections=detections)
+
+                    labels = None
+                    if detections.tracker_id is not None:
+                        # Keep detections with confidence greater than the threshold
+                        detections = detections[(detections.confidence > confidence)]
+                        for trk_id, cls_id in zip(detections.tracker_id, detections.class_id):
+                            tracks.setdefault(self.class_dict[cls_id], set()).add(int(trk_id))
+                        labels = [f"{self.class_dict[cls_id]} {conf*100:.2f}%" for cls_id, conf in zip(
+                                  detections.class_id, detections.confidence)]
+                    busy["inference"] += time.perf_counter() - started
+                    if not result_queue.put((frame, detections, labels)):
+                        break
+            finally:
+                result_queue.put(_END_OF_STREAM)
+
+        def write():
+            while True:
+                item = result_queue.get()
+                if item is _END_OF_STREAM:
+                    break
+                started = time.perf_counter()
+                frame, detections, labels = item
+                if labels is not None:
+                    # Annotate the frame with bounding boxes and labels
+                    box_annotator.annotate(frame, detections=detections)
+                    label_annotator.annotate(frame, detections=detections, labels=labels)
+                out.write(frame)
+                frames[0] += 1
+                busy["write"] += time.perf_counter() - started
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=run_stage, args=(name, body), daemon=True)
+                   for name, body in (("read", read), ("inference", infer), ("write", write))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
 
-    # Convert YOLO result to Detections format
-    detections = sv.Detections.from_ultralytics(result)
+        # Release resources
+        cap.release()
+        out.release()
+        print("Video processing complete, Released resources.")
+        if errors:
+            # The annotated video is incomplete, so report failure rather than partial stats
+            print(f"An error occurred: {'; '.join(errors)}")
+            return None
+
+        pipeline = {
+            "fps": round(frames[0] / elapsed, 2) if elapsed else 0.0,
+            "seconds": round(elapsed, 3),
+            "stage_busy_seconds": {name: round(value, 3) for name, value in busy.items()},
+            # A full queue means the stage after it is the bottleneck
+            "queue_occupancy": {"read->inference": frame_queue.occupancy(),
+                                "inference->write": result_queue.occupancy()},
+        }
+        print(f"Pipeline: {pipeline}")
+        return {"frames": frames[0], "tracks": {name: len(ids) for name, ids in tracks.items()},
+                "pipeline": pipeline}
+
+    def detect_image(self, image_path, confidence=None):
+        """
+        Detections for one image without annotating or writing anything.
+
+        Returns:
+            list of detection records (see detections_to_records), or None if the image couldn't be loaded.
+        """
+        confidence = self.confidence if confidence is None else confidence
+        img = cv.imread(image_path)
+        if img is None:
+            print("Couldn't load the image! Please check the image path.")
+            return None
+        detections = sv.Detections.from_ultralytics(self.model(img, verbose=False)[0])
+        if detections.class_id is not None:
+            detections = detections[(detections.confidence > confidence)]
+        return self.detections_to_records(detections, frame=0)
+
+    def detect_video(self, video_path, confidence=None):
+        """
+        Tracked per-frame detections for a video, skipping annotation and video encoding.
+
+        Returns:
+            list of detection records with frame indexes and track ids, or None if the video couldn't be opened.
+        """
+        confidence = self.confidence if confidence is None else confidence
+        cap = cv.VideoCapture(video_path)
+        if not cap.isOpened():
+            print("Error: couldn't open the video!")
+            return None
+        tracker = sv.ByteTrack(frame_rate=int(cap.get(cv.CAP_PROP_FPS)) or 30)
+        records = []
+        frame_index = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            detections = sv.Detections.from_ultralytics(self.model(frame, verbose=False)[0])
+            detections = tracker.update_with_detections(detections=detections)
+            if detections.tracker_id is not None:
+                detections = detections[(detections.confidence > confidence)]
+                records.extend(self.detections_to_records(detections, frame=frame_index))
+            frame_index += 1
+        cap.release()
+        return records
+
+    def detections_to_records(self, detections, frame=None):
+        """Convert sv.Detections into plain dicts (frame, class, confidence, box, track id)."""
+        if detections is None or detections.class_id is None:
+            return []
+        tracker_ids = detections.tracker_id if detections.tracker_id is not None else [None] * len(detections)
+        return [
+            {
+                "frame": frame,
+                "class": self.class_dict[int(cls_id)],
+                "class_id": int(cls_id),
+                "confidence": round(float(conf), 4),
+                "box": [round(float(v), 1) for v in box],
+                "track_id": None if trk_id is None else int(trk_id),
+            }
+            for box, cls_id, conf, trk_id in zip(detections.xyxy, detections.class_id,
+                                                 detections.confidence, tracker_ids)
+        ]
+
+
+# ## Structured detection output
+def write_detections(records, path, class_names=None):
+    """
+    Save detection records as JSON Lines (.jsonl) or a compact NumPy archive (.npz).
 
-    # Filter detections based on confidence threshold and check if any exist
-    if detections.class_id is not None:
-        detections = detections[(detections.confidence > confidence)]
+    The .npz layout holds one array per field: frame (int32), class_id (int16),
+    confidence (float32), box (float32, N x 4, xyxy) and track_id (int32, -1 if untracked),
+    plus class_names so the class ids can be resolved without the model.
+    """
+    if path.endswith(".npz"):
+        np.savez_compressed(
+            path,
+            frame=np.array([r["frame"] or 0 for r in records], dtype=np.int32),
+            class_id=np.array([r["class_id"] for r in records], dtype=np.int16),
+            confidence=np.array([r["confidence"] for r in records], dtype=np.float32),
+            box=np.array([r["box"] for r in records], dtype=np.float32).reshape(-1, 4),
+            track_id=np.array([-1 if r["track_id"] is None else r["track_id"] for r in records], dtype=np.int32),
+            class_names=np.array([class_names[i] for i in sorted(class_names)] if class_names else []),
+        )
+    else:
+        with open(path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+
+def load_detections(path):
+    """Read records written by write_detections back into a list of dicts."""
+    if not path.endswith(".npz"):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    data = np.load(path)
+    class_names = list(data["class_names"])
+    return [
+        {
+            "frame": int(frame),
+            "class": class_names[cls_id] if cls_id < len(class_names) else str(cls_id),
+            "class_id": int(cls_id),
+            "confidence": float(conf),
+            "box": [float(v) for v in box],
+            "track_id": None if trk_id < 0 else int(trk_id),
+        }
+        for frame, cls_id, conf, box, trk_id in zip(data["frame"], data["class_id"], data["confidence"],
+                                                    data["box"], data["track_id"])
+    ]
+
+
+def species_counts(records, confidence=0.5, aggregation="max"):
+    """
+    Per-species counts from detection records, with the taggers' aggregation semantics:
+    "max" (highest count in any frame), "sum" (all detections) or "tracks" (distinct track ids).
+    """
+    per_frame = {}
+    track_ids = {}
+    for r in records:
+        if r["confidence"] <= confidence:
+            continue
+        species = r["class"].lower()
+        frame_counts = per_frame.setdefault(r["frame"], {})
+        frame_counts[species] = frame_counts.get(species, 0) + 1
+        if r["track_id"] is not None:
+            track_ids.setdefault(species, set()).add(r["track_id"])
+
+    if aggregation == "tracks":
+        return {species: len(ids) for species, ids in track_ids.items()}
+    counts = {}
+    for frame_counts in per_frame.values():
+        for species, count in frame_counts.items():
+            if aggregation == "sum":
+                counts[species] = counts.get(species, 0) + count
+            else:
+                counts[species] = max(counts.get(species, 0), count)
+    return counts
+
+
+# Detectors shared by the function wrappers below, keyed by model path
+_detectors = {}
+
+def get_detector(model="./model.pt"):
+    """Return the cached Detector for a model path, loading the weights on first use."""
+    if model not in _detectors:
+        _detectors[model] = Detector(model)
+    return _detectors[model]
 
-        # Create labels for the detected objects
-        labels = [f"{class_dict[cls_id]} {conf*100:.2f}%" for cls_id, conf in 
-                  zip(detections.class_id, detections.confidence)]
 
-        # Annotate the image with boxes and labels
-        box_annotator.annotate(img, detections=detections)
-        label_annotator.annotate(img, detections=detections, labels=labels)
+def image_prediction(image_path, result_filename=None, save_dir = "./image_prediction_results", confidence=0.5, model="./model.pt"):
+    """
+    Function to display predictions of a pre-trained YOLO model on a given image.
 
-    if result_filename:
-        os.makedirs(save_dir, exist_ok=True)  # Ensure the save directory exists
-        save_path = os.path.join(save_dir, result_filename)
-        try:
-            status = cv.imwrite(save_path, img)
-            print(f"Image save status = {status}.")
-        except Exception as e:
-            print(f"Error saving image: {e}")
-    else:
-        print("Filename is none, result is not saved.")
+    Parameters:
+        image_path (str): Path to the image file. Can be a local path or a URL.
+        result_path (str): If not None, this is the output filename.
+        confidence (float): 0-1, only results over this value are saved.
+        model (str): path to the model.
+    """
+    return get_detector(model).predict_image(image_path, result_filename, save_dir, confidence)
 
 
 # ## Video Detection
-def video_prediction(video_path, result_filename=None, save_dir = "./video_prediction_results", confidence=0.5, model="./model.pt"):
+def video_prediction(video_path, result_filename=None, save_dir = "./video_prediction_results", confidence=0.5, model="./model.pt", codec="XVID"):
     """
     Function to make predictions on video frames using a trained YOLO model and display the video with annotations.
 
@@ -90,84 +518,151 @@ def video_prediction(video_path, result_filename=None, save_dir = "./video_predi
         video_path (str): Path to the video file.
         save_video (bool): If True, saves the video with annotations. Default is False.
         filename (str): The name of the output file where the video will be saved if save_video is True.
+        codec (str): FourCC of the output writer ("XVID", "mp4v" or "MJPG").
     """
-    try:
-        # Load video info and extract width, height, and frames per second (fps)
-        video_info = sv.VideoInfo.from_video_path(video_path=video_path)
-        w, h, fps = int(video_info.width), int(video_info.height), int(video_info.fps)
-
-        # Calculate the optimal thickness for annotations and text scale based on video resolution
-        thickness = sv.calculate_optimal_line_thickness(resolution_wh=video_info.resolution_wh)
-        text_scale = sv.calculate_optimal_text_scale(resolution_wh=video_info.resolution_wh)
-
-        # Initialize YOLO model, tracker, and color lookup for annotations
-        box_annotator = sv.BoxAnnotator(thickness=thickness, color_lookup=sv.ColorLookup.TRACK)
-        label_annotator = sv.LabelAnnotator(text_scale=text_scale, text_thickness=thickness, 
-                                            text_position=sv.Position.TOP_LEFT,
-                                            color_lookup=sv.ColorLookup.TRACK)
-
-        model = YOLO(model)  # Load your custom-trained YOLO model
-        tracker = sv.ByteTrack(frame_rate=fps)  # Initialize the tracker with the video's frame rate
-        class_dict = model.names  # Get the class labels from the model
-
-        # Directory to save the video with annotations, if required
-        
-        if result_filename:
-            os.makedirs(save_dir, exist_ok=True)  # Ensure save directory exists
-            save_path = os.path.join(save_dir, result_filename)
-            out = cv.VideoWriter(save_path, cv.VideoWriter_fourcc(*"XVID"), fps, (w, h))  # Initialize video writer
-        else:
-            print("Result filename is required to save the video file.")
-            return
-        
-        # Capture the video from the given path
-        cap = cv.VideoCapture(video_path)
-        if not cap.isOpened():
-            raise Exception("Error: couldn't open the video!")
-
-        # Process the video frame by frame
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:  # End of the video
-                break
-
-            # Make predictions on the current frame using the YOLO model
-            result = model(frame)[0]
-            detections = sv.Detections.from_ultralytics(result)  # Convert model output to Detections format
-            detections = tracker.update_with_detections(detections=detections)  # Track detected objects
-
-            # Filter detections based on confidence
-            if detections.tracker_id is not None:
-                detections = detections[(detections.confidence > confidence)]  # Keep detections with confidence greater than a threashold
-
-                # Generate labels for tracked objects
-                labels_0 = [f"#{trk_id} {class_dict[cls_id]} {conf*100:.2f}%" 
-                            for trk_id, cls_id, conf in zip(
-                            detections.tracker_id, detections.class_id, detections.confidence)]
+    return get_detector(model).predict_video(video_path, result_filename, save_dir, confidence, codec)
 
-                labels_1 = [f"{class_dict[cls_id]} {conf*100:.2f}%" for cls_id, conf in zip(
-                            detections.class_id, detections.confidence)]
 
-                # Annotate the frame with bounding boxes and labels
-                box_annotator.annotate(frame, detections=detections)
-                label_annotator.annotate(frame, detections=detections, labels=labels_1)
+# ## Batch annotation CLI
+# Each pool worker holds one Detector for its lifetime
+_worker_detector = None
 
-            # Save the annotated frame to the output video file if save_video is True
-            if result_filename:
-                out.write(frame)
+def _init_worker(model, confidence, threads):
+    global _worker_detector
+    import torch
+    torch.set_num_threads(threads)
+    _worker_detector = Detector(model, confidence)
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
 
-    finally:
-        # Release resources
-        cap.release()
-        if result_filename:
-            out.release()
-        print("Video processing complete, Released resources.")
+def _annotate_file(path, output_path, codec="XVID", detections_format=None):
+    """
+    Annotate one image or video in a pool worker and write its JSON summary.
+    With detections_format ("jsonl" or "npz") only the detections are written, nothing is rendered.
+    """
+    detector = _worker_detector
+    save_dir, result_filename = os.path.split(output_path)
+    summary = {"source": path, "output": output_path}
+    is_video = path.lower().endswith(VIDEO_EXTENSIONS)
+
+    if detections_format:
+        summary["type"] = "video" if is_video else "image"
+        records = detector.detect_video(path) if is_video else detector.detect_image(path)
+        if records is None:
+            raise Exception(f"Couldn't load {path}")
+        summary["output"] = f"{output_path}.detections.{detections_format}"
+        write_detections(records, summary["output"], detector.class_dict)
+        summary["counts"] = species_counts(records, detector.confidence, "tracks" if is_video else "max")
+    elif is_video:
+        summary["type"] = "video"
+        stats = detector.predict_video(path, result_filename, save_dir, codec=codec)
+        if stats is None:
+            raise Exception(f"Couldn't annotate the video {path}")
+        summary.update(stats)
+    else:
+        summary["type"] = "image"
+        detections = detector.predict_image(path, result_filename, save_dir)
+        if detections is None:
+            raise Exception(f"Couldn't load the image {path}")
+        summary["detections"] = detector.detections_to_records(detections)
+        counts = {}
+        for record in summary["detections"]:
+            counts[record["class"]] = counts.get(record["class"], 0) + 1
+        summary["counts"] = counts
+
+    # Written last: its presence marks the file as done for --resume
+    with open(output_path + ".json", "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def collect_inputs(inputs):
+    """
+    Expand directories and glob patterns into (source, relative output name) pairs.
+    Output names are relative to the common parent of all inputs, so a/x.jpg and b/x.jpg
+    keep distinct outputs (a single directory maps to paths relative to itself). A file
+    matched by several inputs is listed once.
+    """
+    extensions = IMAGE_EXTENSIONS + VIDEO_EXTENSIONS
+    sources = []
+    anchors = []
+    for entry in inputs:
+        if os.path.isdir(entry):
+            anchors.append(os.path.abspath(entry))
+            for root, _, names in os.walk(entry):
+                for name in sorted(names):
+                    if name.lower().endswith(extensions):
+                        sources.append(os.path.join(root, name))
+        else:
+            for path in sorted(glob.glob(entry, recursive=True)):
+                if os.path.isfile(path) and path.lower().endswith(extensions):
+                    anchors.append(os.path.dirname(os.path.abspath(path)))
+                    sources.append(path)
+    if not sources:
+        return []
+
+    base = os.path.commonpath(anchors)
+    files = []
+    seen = set()
+    for path in sources:
+        real = os.path.realpath(path)
+        if real in seen:
+            continue
+        seen.add(real)
+        files.append((path, os.path.relpath(os.path.abspath(path), base)))
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Annotate directories of bird images and videos.")
+    parser.add_argument("inputs", nargs="*", help="Input directories, files or glob patterns.")
+    parser.add_argument("-o", "--output-dir", default="./batch_prediction_results")
+    parser.add_argument("-m", "--model", default="./model.pt")
+    parser.add_argument("-c", "--confidence", type=float, default=0.5)
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes, each holding one model (default: all cores).")
+    parser.add_argument("--codec", default="XVID", choices=["XVID", "mp4v", "MJPG"],
+                        help="FourCC for annotated videos.")
+    parser.add_argument("--detections-only", choices=["jsonl", "npz"],
+                        help="Skip rendering and write only detections in this format.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Re-process files that already have a JSON summary.")
+    args = parser.parse_args(argv)
+
+    if not args.inputs:
+        demo()
+        return
 
+    jobs = []
+    skipped = 0
+    for path, rel in collect_inputs(args.inputs):
+        output_path = os.path.join(args.output_dir, rel)
+        if not args.no_resume and os.path.exists(output_path + ".json"):
+            skipped += 1
+            continue
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        jobs.append((path, output_path))
+    print(f"{len(jobs)} files to process, {skipped} already done.")
+    if not jobs:
+        return
 
-if __name__ == '__main__':
+    workers = max(1, min(args.workers, len(jobs)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(args.model, args.confidence, threads)) as pool:
+        futures = {pool.submit(_annotate_file, path, output_path, args.codec, args.detections_only): path for path, output_path in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            path = futures[future]
+            try:
+                summary = future.result()
+                print(f"[{done}/{len(jobs)}] {path}: {summary.get('counts', summary.get('tracks'))}")
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(jobs)}] {path}: failed ({e})")
+    print(f"Finished: {len(jobs) - failed} processed, {failed} failed, {skipped} skipped.")
+
+
+def demo():
     print("predicting...")
     image_prediction("./test_images/crows_1.jpg", result_filename="crows_result1.jpg")
     image_prediction("./test_images/crows_3.jpg", result_filename='crows_detected_2.jpg')
@@ -180,4 +675,8 @@ if __name__ == '__main__':
 
     # uncomment to test video prediction
     # video_prediction("./test_videos/crows.mp4",result_filename='crows_detected.mp4')
-    # video_prediction("./test_videos/kingfisher.mp4",result_filename='kingfisher_detected.mp4')
\ No newline at end of file
+    # video_prediction("./test_videos/kingfisher.mp4",result_filename='kingfisher_detected.mp4')
+
+
+if __name__ == '__main__':
+    main()